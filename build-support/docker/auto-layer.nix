@@ -12,6 +12,10 @@
   maxLayers ? 100,
   fromImage ? null,
   debug ? false,
+  # Store paths smaller than this many bytes never become the root of a layer.
+  minLayerRootSize ? 0,
+  # JSON file mapping store path names to the number of other images they are in.
+  popularityFile ? null,
 }:
 
 runCommand "layers.json"
@@ -48,5 +52,7 @@ runCommand "layers.json"
 
     jq .graph "$NIX_ATTRS_JSON_FILE" > referencesGraph
     ${lib.optionalString debug "export DEBUG=1"}
-    python3 ${./auto-layer.py} referencesGraph $excludePathsFile $availableLayers > $out
+    python3 ${./auto-layer.py} referencesGraph $excludePathsFile $availableLayers \
+      --min-size ${toString minLayerRootSize} \
+      ${lib.optionalString (popularityFile != null) "--popularity ${popularityFile}"} > $out
   ''
@@ -1,10 +1,19 @@
 #!/usr/bin/env python3
 
-# usage: auto-layer.py graph_file [ignore_file] [layer_limit]
+# usage: auto-layer.py graph_file [ignore_file] [layer_limit] [--min-size BYTES] [--popularity FILE]
+#        auto-layer.py --images images_file [ignore_file] [layer_limit] [--min-size BYTES]
+#          [--popularity FILE] [--published FILE]
 
 # graph_file: Path to a json file as generated by writeReferencesGraph
 # ignore_file: Path to a file with a list of store paths that should not appear in the output
 # layer_limit: Maximum number of layers to generate, default 100
+# --min-size: Store paths smaller than this many bytes never become the root of a layer
+# --popularity: Path to a json file mapping store path names (without the hash) to the number of
+#   other images they appear in, to prefer widely used store paths as roots of layers
+# images_file: Path to a json file mapping image names to references graph files, to split the
+#   images into layers together
+# --published: Path to a json file with a list of layers that are already published, each a list
+#   of store paths
 
 # This module tries to split a dependency graph of nix store paths into a
 # limited set of layers that together cover all mentioned paths. It tries to
@@ -40,19 +49,37 @@
 # paths that L depends on, so it makes sense to move the dependencies of L into
 # the same layer as L.
 
-# Possible improvements:
-# - Specifying a size limit below which the algorithm stops using large store
-#   paths as new layer roots might further improve sharing as the layer
-#   boundaries will depend less on the number of larger store paths in the
-#   input.
+# Two options refine which store paths become the roots of layers:
+
+# --min-size sets a size limit below which the algorithm stops using store
+# paths as new layer roots. This might further improve sharing as the layer
+# boundaries will depend less on the number of larger store paths in the
+# input.
+
+# --popularity gives the number of other images each store path name appears
+# in, for example counted over the images of a registry. Store paths are then
+# chosen as roots by the number of bytes a layer of their own would share,
+# their nar size times the number of images they appear in including this
+# one, rather than by their nar size alone. Store paths are matched by name
+# rather than by hash so that a path still counts as popular after its
+# dependencies changed.
+
+# With --images, the references graphs of several images are split into layers
+# together. Primary paths are chosen from all images at once, by their nar size
+# times the number of images they appear in, until one of the images reaches
+# the layer limit. In each image, a path is in the layer of its primary paths
+# if the image has one of them, and otherwise in one layer with the rest of
+# such paths. Since every path of a layer is a dependency of each of its
+# primary paths, the layer is then the same in every image that has it. The
+# largest path of each published layer is chosen first, so that published
+# layers tend to be reused. The output has the layers of every image and a
+# report of the bytes stored in the registry and pulled by hosts, along with
+# the same report for the images layered one at a time.
 
 import json
 import os
 import sys
 
-def layer_count(layer_split):
-    return len(set(layer_split.values()))
-
 def path_key(path):
     hash, name = path.split('-', 1)
     return name, hash
@@ -76,6 +103,154 @@ def dependencies(*todo, key):
     """
     return closure(*todo, key=key) - set(todo)
 
+def topological_order(paths, key):
+    """
+    Order the paths such that every path comes after all its dependencies.
+    References of a path to itself are ignored.
+    """
+    order = []
+    done = set()
+    for path in paths:
+        if path in done:
+            continue
+        stack = [(path, iter(key(path)))]
+        done.add(path)
+        while stack:
+            x, deps = stack[-1]
+            for dep in deps:
+                if dep not in done:
+                    done.add(dep)
+                    stack.append((dep, iter(key(dep))))
+                    break
+            else:
+                stack.pop()
+                order.append(x)
+    return order
+
+def closure_bitsets(order, ids, key):
+    """
+    Find the closure of every path as an integer with the bit of each path
+    in it set, where ids maps every path to its bit. Every path has to come
+    after all its dependencies in order.
+    """
+    closures = [0] * len(ids)
+    for path in order:
+        bits = 1 << ids[path]
+        for dep in key(path):
+            if dep != path:
+                bits |= closures[ids[dep]]
+        closures[ids[path]] = bits
+    return closures
+
+BYTE_BITS = [[i for i in range(8) if byte >> i & 1] for byte in range(256)]
+
+def bit_indices(bits):
+    """
+    The indices of the bits that are set in an integer, in increasing order.
+    """
+    indices = []
+    for offset, byte in enumerate(bits.to_bytes((bits.bit_length() + 7) // 8, "little")):
+        if byte:
+            indices.extend(offset * 8 + i for i in BYTE_BITS[byte])
+    return indices
+
+class LayerSplit:
+    """
+    Maps the id of every path to the id of its layer, while counting the
+    paths in each layer so that the number of layers is always known.
+    Changes since the last commit can be rolled back.
+    """
+
+    def __init__(self, size):
+        self.layers = [0] * size
+        self.counts = {0: size} if size else {}
+        self.changes = []
+
+    def __getitem__(self, path):
+        return self.layers[path]
+
+    def __setitem__(self, path, layer_id):
+        old_layer_id = self.layers[path]
+        if layer_id != old_layer_id:
+            self.changes.append((path, old_layer_id))
+            self.move(path, layer_id)
+
+    def move(self, path, layer_id):
+        old_layer_id = self.layers[path]
+        self.counts[old_layer_id] -= 1
+        if not self.counts[old_layer_id]:
+            del self.counts[old_layer_id]
+        self.counts[layer_id] = self.counts.get(layer_id, 0) + 1
+        self.layers[path] = layer_id
+
+    def layer_count(self):
+        return len(self.counts)
+
+    def add_primary_path(self, path, bit):
+        """
+        Called when a path becomes a primary path, before any layer changes.
+        """
+
+    def remove_primary_path(self, path, bit):
+        """
+        Called when a primary path is rolled back, after its layer changes.
+        """
+
+    def commit(self):
+        self.changes.clear()
+
+    def rollback(self):
+        while self.changes:
+            self.move(*self.changes.pop())
+
+class ImageLayerSplit(LayerSplit):
+    """
+    A LayerSplit of the union of the references graphs of several images,
+    which counts the layers of each image. In an image, a path is in the
+    layer of its primary paths if the image has one of them, and otherwise
+    in a layer with the rest of such paths of that image. Every path of a
+    layer is a dependency of each of its primary paths, so the layer is the
+    same in every image that has one of them and can be shared.
+
+    images: The indices of the images that have each path, by path id.
+    """
+
+    def __init__(self, images, image_count):
+        super().__init__(len(images))
+        self.images = images
+        self.image_primary_paths = [0] * image_count
+        self.image_counts = [{} for _ in range(image_count)]
+        for path_images in images:
+            for image in path_images:
+                self.image_counts[image][0] = self.image_counts[image].get(0, 0) + 1
+
+    def image_layer_id(self, layer_id, image):
+        return layer_id if layer_id & self.image_primary_paths[image] else 0
+
+    def move(self, path, layer_id):
+        old_layer_id = self.layers[path]
+        for image in self.images[path]:
+            counts = self.image_counts[image]
+            old_image_layer_id = self.image_layer_id(old_layer_id, image)
+            image_layer_id = self.image_layer_id(layer_id, image)
+            if image_layer_id != old_image_layer_id:
+                counts[old_image_layer_id] -= 1
+                if not counts[old_image_layer_id]:
+                    del counts[old_image_layer_id]
+                counts[image_layer_id] = counts.get(image_layer_id, 0) + 1
+        super().move(path, layer_id)
+
+    def layer_count(self):
+        return max(map(len, self.image_counts), default=0)
+
+    def add_primary_path(self, path, bit):
+        for image in self.images[path]:
+            self.image_primary_paths[image] |= bit
+
+    def remove_primary_path(self, path, bit):
+        for image in self.images[path]:
+            self.image_primary_paths[image] &= ~bit
+
 def minimal_cover(paths, key):
     """
     The minimal set of paths that together cover all input paths with their
@@ -85,78 +260,143 @@ def minimal_cover(paths, key):
     paths_deps = set.union(*(dependencies(d, key=key) for d in paths))
     return paths - paths_deps
 
-def auto_layer(graph, ignore_paths, layer_limit):
-    # Compute all direct users of each path
-    nodes = {x["path"]: x | {"users": set()} for x in graph}
-    for user in nodes:
-        for ref in nodes[user]["references"]:
-            nodes[ref]["users"] |= {user}
-
-    def node_deps(path):
-        nonlocal nodes
-        return nodes[path]["references"]
-
-    def node_users(path):
-        nonlocal nodes
-        return nodes[path]["users"]
-
-    nodes_by_size = sorted(graph, key=lambda node: node["narSize"])
-
-    # Here starts the main algorithm:
-    # The goal is to split the set of store paths into layers such that the layers are likely to be
-    # reusable and that the closure size is spread out over the layers. We do this by iteratively taking
-    # the largest store path and giving it its own layer. This primary store path becomes the identity
-    # of the layer. We also add every dependency of the identifying store path to the same layer unless
-    # it is also used by something that doesn't depend on the identifying store path. More generally, we
-    # put store paths together in the same layer when the set of other layers that depend on it is the
-    # same.
-
-    # layer_split defines how the layers are currently split. We start with a single layer with no
-    # dependencies. This is encoded as every store path mapped to the empty set of dependencies.
-    # In general, layer_split maps each store path to the set of primary paths that depend on it and
-    # that set defines and identifies the layer.
-    layer_split = {path: frozenset() for path in nodes}
-
-    primary_paths = set()
-    while nodes_by_size:
-        # Every iteration, we choose the next biggest path to be the root of a new layer.
-        new_primary_path = nodes_by_size.pop()["path"]
-        primary_paths.add(new_primary_path)
-        new_layer_split = layer_split.copy()
-        new_layer_split[new_primary_path] = frozenset({new_primary_path})
-        new_primary_path_deps = dependencies(new_primary_path, key=node_deps)
-        new_primary_path_users = dependencies(new_primary_path, key=node_users)
-
-        # Update the set of primary users for every dependency of the new primary path.
-        for dep in new_primary_path_deps:
-            new_layer_split[dep] -= new_primary_path_users
-            if not new_layer_split[dep] & new_primary_path_deps:
-                new_layer_split[dep] |= {new_primary_path}
-
-        # If we exceed the layer limit, we give up. The previous split should be good enough.
-        if layer_count(new_layer_split) > layer_limit:
-            break
-        layer_split = new_layer_split
+class ReferencesGraph:
+    """
+    A references graph as generated by writeReferencesGraph, where paths
+    are numbered such that dependencies come before their users, and the
+    closure of every path in both directions is computed upfront. Sets of
+    paths are then integers with one bit per path, so that the dependencies
+    and the users of each new primary path, and the updates of the layers,
+    are a few bitwise operations rather than traversals.
+    """
 
-    # Main algorithm done, the layers have been chosen.
-    # Now, let's give each layer some metadata, mostly for debugging.
-
-    def layer_info(layer_id):
-        nonlocal nodes
-        nonlocal layer_split
-        # The full set of paths in this layer is all the paths that were assigned to it.
-        paths = {path
-                 for path, layer_id_2 in layer_split.items()
-                 if layer_id == layer_id_2}
-        layerSize = sum(nodes[path]["narSize"] for path in paths)
+    def __init__(self, graph):
+        # Compute all direct users of each path
+        self.nodes = {x["path"]: x | {"users": set()} for x in graph}
+        for user in self.nodes:
+            for ref in self.nodes[user]["references"]:
+                self.nodes[ref]["users"] |= {user}
+
+        self.order = topological_order(self.nodes, key=self.node_deps)
+        self.ids = {path: i for i, path in enumerate(self.order)}
+        self.deps_closures = closure_bitsets(self.order, self.ids, key=self.node_deps)
+        self.users_closures = closure_bitsets(reversed(self.order), self.ids, key=self.node_users)
+        self.sizes = [self.nodes[path]["narSize"] for path in self.order]
+
+    def node_deps(self, path):
+        return self.nodes[path]["references"]
+
+    def node_users(self, path):
+        return self.nodes[path]["users"]
+
+    def split(self, layer_split, candidates, layer_limit):
+        """
+        Choose primary paths among the candidates, in order, until the
+        layer limit is reached, updating layer_split.
+
+        Returns: The ids of the primary paths, in the order they were chosen.
+        """
+        # Here starts the main algorithm:
+        # The goal is to split the set of store paths into layers such that the layers are likely to be
+        # reusable and that the closure size is spread out over the layers. We do this by iteratively taking
+        # the largest store path and giving it its own layer. This primary store path becomes the identity
+        # of the layer. We also add every dependency of the identifying store path to the same layer unless
+        # it is also used by something that doesn't depend on the identifying store path. More generally, we
+        # put store paths together in the same layer when the set of other layers that depend on it is the
+        # same.
+
+        # layer_split defines how the layers are currently split. We start with a single layer with no
+        # dependencies. This is encoded as every store path mapped to the empty set of dependencies.
+        # In general, layer_split maps the id of each store path to the set of primary paths that depend
+        # on it and that set defines and identifies the layer. These sets have one bit per primary path,
+        # in the order they were chosen, so that they stay small. It is updated in place, so that trying
+        # a new primary path only costs as much as the number of paths it affects.
+
+        # The primary paths chosen so far, as bits of path ids, in the order they were chosen, and the
+        # bit of each of them in the layer ids.
+        primary_paths = 0
+        primary_path_ids = []
+        primary_path_bits = {}
+
+        def primary_bits(paths):
+            """
+            Convert a set of primary paths as bits of path ids to bits of primary paths.
+            """
+            bits = 0
+            for i in bit_indices(paths):
+                bits |= primary_path_bits[i]
+            return bits
+
+        def add_primary_path(new_primary_path):
+            nonlocal primary_paths
+            new_primary_path_bit = 1 << len(primary_path_ids)
+            layer_split.add_primary_path(new_primary_path, new_primary_path_bit)
+            layer_split[new_primary_path] = new_primary_path_bit
+            new_primary_path_deps = self.deps_closures[new_primary_path] & ~(1 << new_primary_path)
+            new_primary_path_users = self.users_closures[new_primary_path] & ~(1 << new_primary_path)
+            primary_deps = primary_bits(new_primary_path_deps & primary_paths)
+            primary_users = primary_bits(new_primary_path_users & primary_paths)
+
+            # Update the set of primary users for every dependency of the new primary path.
+            for dep in bit_indices(new_primary_path_deps):
+                layer_id = layer_split[dep] & ~primary_users
+                if not layer_id & primary_deps:
+                    layer_id |= new_primary_path_bit
+                layer_split[dep] = layer_id
+
+            primary_paths |= 1 << new_primary_path
+            primary_path_bits[new_primary_path] = new_primary_path_bit
+            primary_path_ids.append(new_primary_path)
+
+        def rollback():
+            """
+            Undo the changes since the last commit, which added the last primary path.
+            """
+            nonlocal primary_paths
+            layer_split.rollback()
+            path = primary_path_ids.pop()
+            layer_split.remove_primary_path(path, primary_path_bits.pop(path))
+            primary_paths &= ~(1 << path)
+
+        for new_primary_path in candidates:
+            add_primary_path(new_primary_path)
+
+            # If we exceed the layer limit, we give up. The previous split should be good enough.
+            if layer_split.layer_count() > layer_limit:
+                rollback()
+                break
+            layer_split.commit()
+
+        return primary_path_ids
+
+    def layer_info(self, layer_id, paths):
+        """
+        Some metadata of a layer, mostly for debugging.
+        """
+        layerSize = sum(self.nodes[path]["narSize"] for path in paths)
+        layer_closure = 0
+        for path in paths:
+            layer_closure |= self.deps_closures[self.ids[path]]
         return {
             "usedBy": sorted(layer_id, key=path_key),
             "paths": sorted(paths, key=path_key),
             "layerSize": layerSize,
-            "closureSize": sum(nodes[path]["narSize"] for path in closure(*paths, key=node_deps)),
+            "closureSize": sum(self.sizes[i] for i in bit_indices(layer_closure)),
         }
 
-    layers = {layer_id: layer_info(layer_id)
+def order_layers(refs, layer_split, ignore_paths):
+    """
+    Describe the layers of a split, which maps paths to their layer id, and
+    order them. Layers with only ignored paths are left out.
+
+    Returns: A list of layers, each defined as a list of store paths.
+    """
+    # The full set of paths in a layer is all the paths that were assigned to it.
+    layer_paths = {}
+    for path, layer_id in layer_split.items():
+        layer_paths.setdefault(layer_id, set()).add(path)
+
+    layers = {layer_id: refs.layer_info(layer_id, layer_paths[layer_id])
               for layer_id in set(layer_split.values())}
 
     # The layer order doesn't actually matter for docker but it's still kind of neat to have layers come
@@ -169,7 +409,7 @@ def auto_layer(graph, ignore_paths, layer_limit):
 
     # Sanity check that no store path ends up in multiple layers.
     total_layer_size = sum(node["layerSize"] for node in layer_order)
-    total_nar_size = sum(node["narSize"] for node in graph)
+    total_nar_size = sum(refs.nodes[path]["narSize"] for path in layer_split)
     assert total_layer_size == total_nar_size, (total_layer_size, total_nar_size)
 
     # Format as a list of layers, each defined as a list of store paths.
@@ -179,6 +419,136 @@ def auto_layer(graph, ignore_paths, layer_limit):
             for layer in layer_order
             if set(layer["paths"]) - ignore_paths]
 
+def auto_layer(graph, ignore_paths, layer_limit, min_size=0, popularity=None):
+    refs = ReferencesGraph(graph)
+
+    def root_score(node):
+        name, _ = path_key(node["path"])
+        return node["narSize"] * (popularity.get(name, 0) + 1)
+
+    if popularity:
+        nodes_by_size = sorted(graph, key=root_score)
+    else:
+        nodes_by_size = sorted(graph, key=lambda node: node["narSize"])
+    nodes_by_size = [node for node in nodes_by_size if node["narSize"] >= min_size]
+
+    # Every iteration, we choose the next biggest (or most shared) path to be the root of a new
+    # layer.
+    candidates = [refs.ids[node["path"]] for node in reversed(nodes_by_size)]
+
+    layer_split = LayerSplit(len(refs.order))
+    primary_path_ids = refs.split(layer_split, candidates, layer_limit)
+
+    # Main algorithm done, the layers have been chosen.
+    # Turn the layers back into sets of paths, for every path in the original order.
+    layer_ids = {bits: frozenset(refs.order[primary_path_ids[i]] for i in bit_indices(bits))
+                 for bits in set(layer_split.layers)}
+    layer_split = {path: layer_ids[layer_split[refs.ids[path]]] for path in refs.nodes}
+
+    return order_layers(refs, layer_split, ignore_paths)
+
+def auto_layer_images(graphs, ignore_paths, layer_limit, min_size=0, popularity=None, published=()):
+    """
+    Split the store paths of several images into layers together, such that
+    layers are shared between images as much as possible.
+
+    graphs: Maps the name of each image to its references graph.
+    popularity: The number of other images each store path name is in, besides these images.
+    published: Layers that are already published, each a list of store paths.
+
+    Returns: A dict with the layers of each image and a report of the bytes
+             that are stored and pulled.
+    """
+    names = list(graphs)
+    union = {}
+    for graph in graphs.values():
+        for node in graph:
+            union.setdefault(node["path"], node)
+    refs = ReferencesGraph(list(union.values()))
+
+    images = [[] for _ in refs.order]
+    for image, name in enumerate(names):
+        for node in graphs[name]:
+            images[refs.ids[node["path"]]].append(image)
+
+    # Paths are chosen as primary paths by the number of bytes a layer of their own would share,
+    # with the largest path of each published layer first, so that its boundaries tend to stay.
+    published_roots = {max(layer, key=lambda path: refs.nodes[path]["narSize"])
+                       for layer in published
+                       if layer and all(path in refs.nodes for path in layer)}
+    popularity = popularity or {}
+
+    def root_score(path):
+        name, _ = path_key(path)
+        return (path in published_roots,
+                refs.nodes[path]["narSize"] * (len(images[refs.ids[path]]) + popularity.get(name, 0)))
+
+    nodes_by_score = sorted((path for path in union if union[path]["narSize"] >= min_size),
+                            key=root_score)
+    candidates = [refs.ids[path] for path in reversed(nodes_by_score)]
+
+    layer_split = ImageLayerSplit(images, len(names))
+    primary_path_ids = refs.split(layer_split, candidates, layer_limit)
+
+    layer_ids = {bits: frozenset(refs.order[primary_path_ids[i]] for i in bit_indices(bits))
+                 for bits in set(layer_split.layers)}
+    # An image without the primary paths of a path has it in its layer of the rest, even if no
+    # path is in that layer in the union.
+    layer_ids[0] = frozenset()
+    image_layers = {}
+    for image, name in enumerate(names):
+        image_layer_split = {
+            node["path"]: layer_ids[layer_split.image_layer_id(layer_split[refs.ids[node["path"]]], image)]
+            for node in graphs[name]
+        }
+        image_layers[name] = order_layers(refs, image_layer_split, ignore_paths)
+
+        # Sanity check that the layers of every image are exactly its paths, within the limit.
+        image_paths = [path for layer in image_layers[name] for path in layer]
+        graph_paths = {node["path"] for node in graphs[name]} - ignore_paths
+        assert len(image_paths) == len(graph_paths) and set(image_paths) == graph_paths, name
+        assert len(image_layers[name]) <= layer_limit, (name, len(image_layers[name]))
+
+    def report(image_layers):
+        """
+        Score a layering of the images by the bytes that are stored in a registry and that are
+        pulled to a host, counting each layer once, and the bytes of layers that are not yet
+        published.
+        """
+        published_layers = {frozenset(layer) for layer in published}
+        layer_images = {}
+        for layers in image_layers.values():
+            for layer in layers:
+                layer_images[frozenset(layer)] = layer_images.get(frozenset(layer), 0) + 1
+
+        def size(layer):
+            return sum(refs.nodes[path]["narSize"] for path in layer)
+
+        return {
+            "images": len(image_layers),
+            "layers": len(layer_images),
+            "sharedLayers": sum(count > 1 for count in layer_images.values()),
+            "publishedLayers": len(layer_images.keys() & published_layers),
+            # Pulling every image on its own, onto an empty host.
+            "pullBytes": sum(size(layer) for layers in image_layers.values() for layer in layers),
+            # Storing every layer once, which is also pulling all images onto the same host.
+            "storageBytes": sum(size(layer) for layer in layer_images),
+            "newStorageBytes": sum(size(layer) for layer in layer_images
+                                   if layer not in published_layers),
+            "sharedBytes": sum(size(layer) * (count - 1) for layer, count in layer_images.items()),
+        }
+
+    # For comparison, the same images layered one at a time.
+    independent_layers = {name: auto_layer(graph, ignore_paths, layer_limit, min_size, popularity)
+                          for name, graph in graphs.items()}
+
+    return {
+        "images": image_layers,
+        "report": report(image_layers) | {
+            "independent": report(independent_layers),
+        },
+    }
+
 if __name__ == '__main__':
     import argparse
 
@@ -187,14 +557,46 @@ if __name__ == '__main__':
         description='Split store paths into docker layers.'
     )
     parser.add_argument('graph_file')
-    parser.add_argument('ignore_file', default="/dev/null")
-    parser.add_argument('layer_limit', type=int, default=100)
+    parser.add_argument('ignore_file', nargs='?', default="/dev/null")
+    parser.add_argument('layer_limit', nargs='?', type=int, default=100)
+    parser.add_argument('--min-size', type=int, default=0,
+                        help='smallest nar size in bytes of a store path to become the root of a layer')
+    parser.add_argument('--popularity',
+                        help='json file with the number of other images each store path name is in')
+    parser.add_argument('--images', action='store_true',
+                        help='graph_file is a json object mapping image names to references graph '
+                             'files, which are split into layers together')
+    parser.add_argument('--published',
+                        help='json file with the layers already published, with --images')
     args = parser.parse_args()
 
-    with open(args.graph_file) as f:
-        graph = json.load(f)
-
     with open(args.ignore_file) as f:
         ignore_paths = {line.strip() for line in f}
 
-    print(json.dumps(auto_layer(graph, ignore_paths, args.layer_limit)))
+    popularity = {}
+    if args.popularity:
+        with open(args.popularity) as f:
+            popularity = json.load(f)
+
+    if args.images:
+        with open(args.graph_file) as f:
+            graph_files = json.load(f)
+
+        graphs = {}
+        for name, graph_file in graph_files.items():
+            with open(graph_file) as f:
+                graphs[name] = json.load(f)
+
+        published = []
+        if args.published:
+            with open(args.published) as f:
+                published = json.load(f)
+
+        print(json.dumps(auto_layer_images(graphs, ignore_paths, args.layer_limit, args.min_size,
+                                           popularity, published)))
+        sys.exit()
+
+    with open(args.graph_file) as f:
+        graph = json.load(f)
+
+    print(json.dumps(auto_layer(graph, ignore_paths, args.layer_limit, args.min_size, popularity)))
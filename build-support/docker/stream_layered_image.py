@@ -26,33 +26,113 @@ case) and the size of the tarball before we can start adding it to the
 outer tarball.  We achieve that by creating the layer tarballs twice;
 on the first iteration we calculate the file size and the checksum,
 and on the second one we actually stream the contents. 'add_layer_dir'
-function does all this.
+function does all this. The second pass is written by 'TarWriter'
+straight to stdout, and file contents are copied with sendfile(2)
+rather than through Python.
+
+With '--single-pass', the size of each layer tarball is instead
+calculated from the file metadata alone, since tar framing is
+deterministic, and the checksum is calculated while streaming the
+contents. The layer tarballs are then named after their store paths
+rather than their checksum, which only ends up in the image
+configuration.
+
+With '--format=oci', the image is written as an OCI image layout [3]
+instead, where layers are blobs named after their checksum. They can be
+compressed with '--compression', in which case the first pass also
+compresses the layer to calculate the checksum of the blob, and the
+second one compresses it again while streaming it. Compression is
+deterministic, so both passes produce the same bytes.
+
+With '--plan', nothing is streamed: the sizes of the layer tarballs are
+calculated from the file metadata like with '--single-pass', and written
+to stdout as JSON along with file counts.
 
 [1]: https://github.com/moby/moby/blob/master/image/spec/v1.2.md
 [2]: https://github.com/moby/moby/blob/4fb59c20a4fb54f944fe170d0ff1d00eb4a24d6f/image/spec/v1.2.md#image-json-field-descriptions
+[3]: https://github.com/opencontainers/image-spec/blob/main/image-layout.md
 """  # noqa: E501
 
 import argparse
+import contextlib
+import errno
 import io
 import os
 import re
+import stat
 import sys
+import time
 import json
 import hashlib
 import pathlib
 import tarfile
+import tempfile
+import zlib
+import functools
 import itertools
-import threading
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timezone
-from collections import namedtuple
+from collections import deque, namedtuple
 
+try:
+    from compression import zstd
+except ImportError:
+    # Only available from Python 3.14.
+    zstd = None
 
-def archive_paths_to(obj, paths, mtime, uid, gid, uname, gname):
+
+def file_checksum(filename):
     """
-    Writes the given store paths as a tar file to the given stream.
+    Returns: Hex-encoded sha256sum of the contents of the given file.
+    """
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while data := f.read(64 * 1024):
+            digest.update(data)
+    return digest.hexdigest()
 
-    obj: Stream to write to. Should have a 'write' method.
+
+def walk_path(path):
+    """
+    Lists a store path and everything below it with 'os.scandir', without
+    following symlinks. Entries are sorted by name within each directory
+    and directories are followed by their contents, which is the order
+    'sorted' puts the same 'pathlib.Path' objects in.
+
+    path: Normalised store path.
+
+    Returns: A generator of file names.
+    """
+
+    def walk_dir(directory):
+        with os.scandir(directory) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        for entry in entries:
+            yield entry.path
+            if entry.is_dir(follow_symlinks=False):
+                yield from walk_dir(entry.path)
+
+    yield path
+    if not os.path.islink(path) and os.path.isdir(path):
+        yield from walk_dir(path)
+
+
+def layer_members(tar, paths, mtime, uid, gid, uname, gname, dedup=None):
+    """
+    Yields the members of the tar file of the given store paths, in the
+    order they are archived.
+
+    tar: 'tarfile.TarFile' or 'TarWriter' object used to create the
+         'TarInfo' objects.
     paths: List of store paths.
+    dedup: By default, hardlinks are archived as regular files. With
+           "hardlinks", they are archived as hardlinks to the first file
+           with the same inode instead. With "content", regular files with
+           the same contents and mode are archived as hardlinks as well.
+
+    Returns: A generator of ('TarInfo', filename) tuples, where filename is
+             the file to read the contents of the member from, or 'None'
+             if it has no contents.
     """
 
     # gettarinfo makes the paths relative, this makes them
@@ -78,34 +158,357 @@ def archive_paths_to(obj, paths, mtime, uid, gid, uname, gname):
         ti.type = tarfile.DIRTYPE
         return ti
 
+    # Names of the regular files archived so far, by size and mode. Files
+    # are only hashed once another one has the same size and mode.
+    by_size = {}
+    by_content = {}
+
+    # Returns: The name of the first file archived with the same contents
+    #          and mode, which is 'ti.name' if there is none.
+    def find_duplicate(ti, filename):
+        key = (ti.size, ti.mode)
+        if key not in by_size:
+            by_size[key] = (filename, ti.name)
+            return ti.name
+
+        first = by_size[key]
+        if first is not None:
+            by_content[(*key, file_checksum(first[0]))] = first[1]
+            by_size[key] = None
+
+        return by_content.setdefault((*key, file_checksum(filename)), ti.name)
+
+    # To be consistent with the docker utilities, we need to have
+    # these directories first when building layer tarballs.
+    yield apply_filters(nix_root(dir("/nix"))), None
+    yield apply_filters(nix_root(dir("/nix/store"))), None
+
+    for path in paths:
+        for filename in walk_path(os.path.normpath(path)):
+            ti = append_root(tar.gettarinfo(filename))
+
+            # copy hardlinks as regular files
+            if ti.islnk() and dedup is None:
+                ti.type = tarfile.REGTYPE
+                ti.linkname = ""
+                ti.size = os.stat(filename).st_size
+            elif ti.islnk():
+                ti.linkname = "/" + ti.linkname
+            elif dedup == "content" and ti.isfile() and ti.size > 0:
+                linkname = find_duplicate(ti, filename)
+                if linkname != ti.name:
+                    ti.type = tarfile.LNKTYPE
+                    ti.linkname = linkname
+                    ti.size = 0
+
+            ti = apply_filters(ti)
+            yield ti, filename if ti.isfile() else None
+
+
+def add_paths_to(tar, paths, mtime, uid, gid, uname, gname, dedup=None):
+    """
+    Adds the given store paths to a tar file.
+
+    tar: 'tarfile.TarFile' or 'TarWriter' object to add the files to.
+    paths: List of store paths.
+    dedup: See 'layer_members'.
+    """
+
+    members = layer_members(
+        tar, paths, mtime, uid, gid, uname, gname, dedup
+    )
+    for ti, filename in members:
+        if filename is None:
+            tar.addfile(ti)
+        else:
+            with open(filename, "rb") as f:
+                tar.addfile(ti, f)
+
+
+def archive_paths_to(
+    obj, paths, mtime, uid, gid, uname, gname, dedup=None
+):
+    """
+    Writes the given store paths as a tar file to the given stream.
+
+    obj: Stream to write to. Should have a 'write' method.
+    paths: List of store paths.
+    dedup: See 'layer_members'.
+    """
+
     with tarfile.open(fileobj=obj, mode="w|") as tar:
-        # To be consistent with the docker utilities, we need to have
-        # these directories first when building layer tarballs.
-        tar.addfile(apply_filters(nix_root(dir("/nix"))))
-        tar.addfile(apply_filters(nix_root(dir("/nix/store"))))
-
-        for path in paths:
-            path = pathlib.Path(path)
-            if path.is_symlink():
-                files = [path]
-            else:
-                files = itertools.chain([path], path.rglob("*"))
+        add_paths_to(tar, paths, mtime, uid, gid, uname, gname, dedup)
 
-            for filename in sorted(files):
-                ti = append_root(tar.gettarinfo(filename))
 
-                # copy hardlinks as regular files
-                if ti.islnk():
-                    ti.type = tarfile.REGTYPE
-                    ti.linkname = ""
-                    ti.size = filename.stat().st_size
+def tar_size(tar, members):
+    """
+    Calculates the size of a tar file from the metadata of its members.
+    Tar framing is deterministic: each member is a header followed by its
+    contents padded to whole blocks, and the end of the archive is two
+    zero blocks, padded to a whole record.
 
-                ti = apply_filters(ti)
-                if ti.isfile():
-                    with open(filename, "rb") as f:
-                        tar.addfile(ti, f)
-                else:
-                    tar.addfile(ti)
+    tar: 'tarfile.TarFile' object the headers would be written with.
+    members: Iterable of 'TarInfo' objects.
+
+    Returns: The size of the tar file in bytes.
+    """
+
+    def round_up(size, multiple):
+        return -(-size // multiple) * multiple
+
+    size = 0
+    for ti in members:
+        size += len(ti.tobuf(tar.format, tar.encoding, tar.errors))
+        size += round_up(ti.size, tarfile.BLOCKSIZE)
+
+    return round_up(size + 2 * tarfile.BLOCKSIZE, tarfile.RECORDSIZE)
+
+
+def layer_tar_size(paths, mtime, uid, gid, uname, gname, dedup=None):
+    """
+    Calculates the size of the tar file 'archive_paths_to' writes for the
+    given store paths without reading their contents.
+
+    paths: List of store paths.
+
+    Returns: The size of the tar file in bytes.
+    """
+
+    with open(os.devnull, "wb") as null:
+        with tarfile.open(fileobj=null, mode="w|") as tar:
+            members = layer_members(
+                tar, paths, mtime, uid, gid, uname, gname, dedup
+            )
+            return tar_size(tar, (ti for ti, _ in members))
+
+
+def layer_stats(paths, mtime, uid, gid, uname, gname, dedup=None):
+    """
+    Calculates the size of the tar file 'archive_paths_to' writes for the
+    given store paths and counts its members, without reading their
+    contents.
+
+    paths: List of store paths.
+    dedup: See 'layer_members'.
+
+    Returns: A 'dict' with the size of the tar file, its number of members,
+             of regular files and the total size of their contents.
+    """
+    stats = {"size": 0, "entries": 0, "files": 0, "file_bytes": 0}
+
+    def count(members):
+        for ti, filename in members:
+            stats["entries"] += 1
+            if filename is not None:
+                stats["files"] += 1
+                stats["file_bytes"] += ti.size
+            yield ti
+
+    with open(os.devnull, "wb") as null:
+        with tarfile.open(fileobj=null, mode="w|") as tar:
+            members = layer_members(
+                tar, paths, mtime, uid, gid, uname, gname, dedup
+            )
+            stats["size"] = tar_size(tar, count(members))
+
+    return stats
+
+
+def compressor(compression):
+    """
+    Returns: A new compressor object for the given compression, which
+             compresses deterministically.
+    """
+    if compression == "gzip":
+        # No file name and a zero mtime in the header.
+        return zlib.compressobj(wbits=31)
+    if compression == "zstd":
+        return zstd.ZstdCompressor()
+    raise ValueError(f"Unknown compression: {compression}")
+
+
+def compression_version(compression):
+    """
+    Returns: The version of the library implementing the given compression,
+             which its output depends on, or 'None' without compression.
+    """
+    if compression == "gzip":
+        return zlib.ZLIB_RUNTIME_VERSION
+    if compression == "zstd":
+        return ".".join(map(str, zstd.zstd_version_info))
+    return None
+
+
+def layer_digest(
+    paths,
+    mtime,
+    uid,
+    gid,
+    uname,
+    gname,
+    compression=None,
+    dedup=None,
+    blob_dir=None,
+):
+    """
+    Calculates the checksum and the size of the tar file 'archive_paths_to'
+    writes for the given store paths, and of the blob it is stored as,
+    while discarding their contents.
+
+    paths: List of store paths.
+    compression: 'None', "gzip" or "zstd".
+    dedup: See 'layer_members'.
+    blob_dir: Directory to keep the compressed blob in, named after its
+              checksum, so that it does not need to be compressed again.
+
+    Returns: A 'LayerDigest' object.
+    """
+    if compression is None:
+        extract_checksum = ExtractChecksum()
+        archive_paths_to(
+            extract_checksum, paths, mtime, uid, gid, uname, gname, dedup
+        )
+        (checksum, size) = extract_checksum.extract()
+        return LayerDigest(checksum, size, checksum, size)
+
+    with contextlib.ExitStack() as stack:
+        if blob_dir is None:
+            blob_checksum = ExtractChecksum()
+        else:
+            f = stack.enter_context(
+                tempfile.NamedTemporaryFile(dir=blob_dir, delete=False)
+            )
+            blob_checksum = SaveChecksum(f)
+        output = CompressOutput(blob_checksum, compressor(compression))
+        output.checksum = ExtractChecksum()
+        archive_paths_to(output, paths, mtime, uid, gid, uname, gname, dedup)
+        output.finish()
+    digest = LayerDigest(*output.checksum.extract(), *blob_checksum.extract())
+    if blob_dir is not None:
+        os.replace(f.name, os.path.join(blob_dir, digest.blob_checksum))
+    return digest
+
+
+def iter_layer_digests(
+    store_layers,
+    mtime,
+    uid,
+    gid,
+    uname,
+    gname,
+    jobs,
+    compression=None,
+    dedup=None,
+    blob_dir=None,
+):
+    """
+    Calculates the checksums and the sizes of the tar files of several
+    layers concurrently, compressing them if requested, and yields them in
+    order. At most 'jobs' layers are calculated ahead of the last one
+    yielded, which bounds the number of blobs kept in 'blob_dir' until they
+    are streamed.
+
+    store_layers: List of layers, each one being a list of store paths.
+    jobs: Number of worker processes.
+    compression: 'None', "gzip" or "zstd".
+    dedup: See 'layer_members'.
+    blob_dir: See 'layer_digest'.
+
+    Returns: An iterator of 'LayerDigest' objects, one for each layer.
+    """
+    digest = functools.partial(
+        layer_digest,
+        mtime=mtime,
+        uid=uid,
+        gid=gid,
+        uname=uname,
+        gname=gname,
+        compression=compression,
+        dedup=dedup,
+        blob_dir=blob_dir,
+    )
+    layers = iter(store_layers)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = deque(
+            executor.submit(digest, paths)
+            for paths in itertools.islice(layers, jobs)
+        )
+        while futures:
+            result = futures.popleft().result()
+            for paths in itertools.islice(layers, 1):
+                futures.append(executor.submit(digest, paths))
+            yield result
+
+
+def layer_digests(
+    store_layers,
+    mtime,
+    uid,
+    gid,
+    uname,
+    gname,
+    jobs,
+    compression=None,
+    dedup=None,
+):
+    """
+    Calculates the checksums and the sizes of the tar files of several
+    layers concurrently, like 'iter_layer_digests'. Layers are independent
+    from each other, so this takes about as long as the largest of them.
+
+    Returns: A list of 'LayerDigest' objects, one for each layer.
+    """
+    return list(
+        iter_layer_digests(
+            store_layers,
+            mtime,
+            uid,
+            gid,
+            uname,
+            gname,
+            jobs,
+            compression,
+            dedup,
+        )
+    )
+
+
+def hardlink_groups(paths):
+    """
+    Lists the regular files of the given store paths which are hardlinks to
+    each other.
+
+    paths: List of store paths.
+
+    Returns: A sorted list of sorted lists of file names, one for each
+             inode with more than one name in the store paths.
+    """
+    groups = {}
+    for path in paths:
+        for filename in walk_path(os.path.normpath(path)):
+            st = os.lstat(filename)
+            if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+                groups.setdefault((st.st_dev, st.st_ino), []).append(filename)
+    return sorted(sorted(names) for names in groups.values() if len(names) > 1)
+
+
+def layer_key(paths, mtime, uid, gid, uname, gname, dedup=None):
+    """
+    Returns: A hex-encoded sha256sum identifying the layer tarball of the
+             given store paths, which only depends on the arguments of
+             'archive_paths_to'. Since store paths are immutable, layers
+             with the same key have the same contents. With "hardlinks"
+             dedup, the layer also depends on which files are hardlinks to
+             each other, which changes when the store is optimised, so
+             these are part of the key too.
+    """
+    key = [paths, mtime, uid, gid, uname, gname]
+    if dedup is not None:
+        key.append(dedup)
+    if dedup == "hardlinks":
+        key.append(hardlink_groups(paths))
+    key = json.dumps(key)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
 
 
 class ExtractChecksum:
@@ -129,9 +532,467 @@ class ExtractChecksum:
         return (self._digest.hexdigest(), self._size)
 
 
-FromImage = namedtuple("FromImage", ["tar", "manifest_json", "image_json"])
+class SaveChecksum(ExtractChecksum):
+    """
+    An 'ExtractChecksum' which also writes everything to a file.
+    """
+
+    def __init__(self, f):
+        super().__init__()
+        self._file = f
+
+    def write(self, data):
+        super().write(data)
+        self._file.write(data)
+
+
+def copy_file_to(obj, f, size, bufsize):
+    """
+    Copies 'size' bytes from the current position of a file object to a
+    writable stream, in chunks of at most 'bufsize' bytes.
+
+    Returns: The time spent reading the file object, in seconds.
+    """
+    read_time = 0.0
+    while size > 0:
+        start = time.perf_counter()
+        data = f.read(min(size, bufsize))
+        read_time += time.perf_counter() - start
+        if not data:
+            raise OSError("unexpected end of data")
+        obj.write(data)
+        size -= len(data)
+    return read_time
+
+
+class FdOutput:
+    """
+    A buffered, writable stream over a file descriptor, which can also copy
+    files to it with 'os.sendfile', so that their contents go straight from
+    the page cache to the output instead of through Python.
+
+    While 'checksum' is set to an 'ExtractChecksum' object, everything
+    written is also passed to it, and files are read and written instead.
+
+    'files' counts the files copied, 'read_time' is the time spent reading
+    them and 'write_time' the time spent blocked writing to the file
+    descriptor, in seconds. 'sendfile' both reads and writes, so its time
+    is counted separately as 'copy_time'.
+    """
+
+    bufsize = 64 * 1024
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.size = 0
+        self.checksum = None
+        self.files = 0
+        self.read_time = 0.0
+        self.write_time = 0.0
+        self.copy_time = 0.0
+        self._buf = bytearray()
+        self._sendfile = hasattr(os, "sendfile")
+
+    def write(self, data):
+        if self.checksum is not None:
+            self.checksum.write(data)
+        self._buf += data
+        self.size += len(data)
+        if len(self._buf) >= self.bufsize:
+            self.flush()
+
+    def flush(self):
+        view = memoryview(self._buf)
+        self._buf = bytearray()
+        start = time.perf_counter()
+        while view:
+            view = view[os.write(self.fd, view):]
+        self.write_time += time.perf_counter() - start
+
+    def copy_file(self, f, size):
+        """
+        Copies 'size' bytes from the current position of a file object.
+        """
+        self.files += 1
+        if self._sendfile and self.checksum is None:
+            try:
+                in_fd = f.fileno()
+            except (AttributeError, OSError):
+                in_fd = None
+
+            if in_fd is not None:
+                self.flush()
+                offset = f.tell()
+                start = time.perf_counter()
+                while size > 0:
+                    try:
+                        sent = os.sendfile(self.fd, in_fd, offset, size)
+                    except OSError as e:
+                        # Not every kind of file supports it, for example
+                        # an output opened in append mode.
+                        if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                            raise
+                        self._sendfile = False
+                        f.seek(offset)
+                        break
+                    if sent == 0:
+                        raise OSError("unexpected end of data")
+                    offset += sent
+                    size -= sent
+                    self.size += sent
+                self.copy_time += time.perf_counter() - start
+
+        self.read_time += copy_file_to(self, f, size, self.bufsize)
+
+
+class CompressOutput:
+    """
+    A writable stream which compresses everything written to it into
+    another stream, such as an 'FdOutput'. Its 'size' is the number of
+    bytes written to it before compression. 'finish' must be called once
+    everything has been written.
+
+    While 'checksum' is set to an 'ExtractChecksum' object, everything
+    written is also passed to it before compression.
+
+    'files' and 'read_time' count the files copied as in 'FdOutput'.
+    """
+
+    def __init__(self, output, compressor):
+        self.output = output
+        self.size = 0
+        self.checksum = None
+        self.files = 0
+        self.read_time = 0.0
+        self._compressor = compressor
+
+    def write(self, data):
+        if self.checksum is not None:
+            self.checksum.write(data)
+        self.size += len(data)
+        compressed = self._compressor.compress(data)
+        if compressed:
+            self.output.write(compressed)
+
+    def flush(self):
+        pass
+
+    def copy_file(self, f, size):
+        self.files += 1
+        self.read_time += copy_file_to(self, f, size, FdOutput.bufsize)
+
+    def finish(self):
+        self.output.write(self._compressor.flush())
+
+
+class TarWriter:
+    """
+    Writes a tar file to an 'FdOutput', producing the same bytes as a
+    'tarfile.TarFile' opened in "w|" mode. The headers are created by
+    'tarfile', but file contents are copied with 'FdOutput.copy_file'.
+
+    Members can also be written by the caller with 'addmember', such as a
+    layer tarball written by a nested 'TarWriter' on the same output.
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self._start = output.size
+        # Only used to create 'TarInfo' objects and to get the settings
+        # the headers are written with.
+        self._null = open(os.devnull, "wb")
+        self._tar = tarfile.open(fileobj=self._null, mode="w|")
+        self.format = self._tar.format
+        self.encoding = self._tar.encoding
+        self.errors = self._tar.errors
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self._tar.close()
+            self._null.close()
+
+    def _pad(self, size):
+        remainder = (self.output.size - self._start) % size
+        if remainder > 0:
+            self.output.write(tarfile.NUL * (size - remainder))
+
+    def gettarinfo(self, name):
+        return self._tar.gettarinfo(name)
+
+    def addfile(self, tarinfo, fileobj=None):
+        self.output.write(
+            tarinfo.tobuf(self.format, self.encoding, self.errors)
+        )
+        if fileobj is not None:
+            self.output.copy_file(fileobj, tarinfo.size)
+            self._pad(tarfile.BLOCKSIZE)
+
+    @contextlib.contextmanager
+    def addmember(self, tarinfo):
+        """
+        Adds a member whose contents are written to the 'FdOutput' yielded
+        by this context manager. They must have exactly 'tarinfo.size'
+        bytes.
+        """
+        self.output.write(
+            tarinfo.tobuf(self.format, self.encoding, self.errors)
+        )
+        start = self.output.size
+        yield self.output
+        size = self.output.size - start
+        if size != tarinfo.size:
+            raise OSError(
+                f"{tarinfo.name} has {size} bytes"
+                f" instead of the expected {tarinfo.size}"
+            )
+        self._pad(tarfile.BLOCKSIZE)
+
+    def close(self):
+        self.output.write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+        self._pad(tarfile.RECORDSIZE)
+        self.output.flush()
+        self._tar.close()
+        self._null.close()
+
+
+class ChecksumCache:
+    """
+    On-disk cache of the checksums and sizes of layer tarballs.
+
+    Store paths are immutable, so the tarball of a layer only depends on
+    its store paths and the ownership and mtime of its files, which is
+    what 'layer_key' hashes. Entries also record the Python version, as
+    the tar headers are written by its 'tarfile' module, and the version
+    of the compression library for compressed layers.
+    """
+
+    version = 2
+
+    def __init__(self, directory):
+        self.directory = pathlib.Path(directory)
+        self.hits = 0
+        self.misses = 0
+
+    def _entry(self, key, compression):
+        if compression is None:
+            return self.directory / f"{key}.json"
+        return self.directory / f"{key}.{compression}.json"
+
+    def _versions(self, compression):
+        return {
+            "version": self.version,
+            "python": list(sys.version_info[:2]),
+            "compression": compression_version(compression),
+        }
+
+    def get(self, key, compression=None):
+        """
+        Returns: A 'LayerDigest' object, or 'None' if the layer is not in
+                 the cache.
+        """
+        try:
+            with open(self._entry(key, compression)) as f:
+                entry = json.load(f)
+            versions = self._versions(compression)
+            if all(entry[name] == value for name, value in versions.items()):
+                self.hits += 1
+                return LayerDigest(*entry["digest"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        self.misses += 1
+        return None
+
+    def put(self, key, digest, compression=None):
+        """
+        Records the digest of a layer. The entry is renamed into place, as
+        several images sharing layers may be built at the same time.
+        """
+        entry = {**self._versions(compression), "digest": list(digest)}
+        path = self._entry(key, compression)
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            tmp.write_text(json.dumps(entry))
+            tmp.replace(path)
+        except OSError as e:
+            print(
+                f"Could not write checksum cache entry {path}: {e}",
+                file=sys.stderr,
+            )
+
+
+def default_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(
+        "~/.cache"
+    )
+    return os.path.join(cache_home, "stream_layered_image")
+
+
+class Metrics:
+    """
+    Writes progress events for each layer, and a summary once the image is
+    written, to a file as JSON lines. The events are measured from the
+    counters of the 'FdOutput' the image is written to.
+
+    Each layer event has the number of bytes hashed by the first pass and
+    the time it took, the number of bytes and files streamed, the time
+    spent reading files and blocked writing the output, and the time spent
+    copying files with 'sendfile', which does both. 'other_time' is the
+    rest of the time spent on the layer, such as compression.
+    """
+
+    counters = ["size", "files", "read_time", "write_time", "copy_time"]
+
+    def __init__(self, path, output):
+        self.file = open(path, "w")
+        self.output = output
+        self.start = time.perf_counter()
+        self.totals = {
+            "layers": 0,
+            "bytes_hashed": 0,
+            "hash_time": 0.0,
+            "bytes_streamed": 0,
+            "files": 0,
+            "read_time": 0.0,
+            "write_time": 0.0,
+            "copy_time": 0.0,
+        }
+        self.mark()
+
+    def mark(self):
+        """
+        Starts measuring the next layer.
+        """
+        self._time = time.perf_counter()
+        self._counters = [getattr(self.output, c) for c in self.counters]
+
+    def event(self, event, **fields):
+        self.file.write(json.dumps({"event": event, **fields}) + "\n")
+        self.file.flush()
+
+    def layer(
+        self,
+        num,
+        kind,
+        paths,
+        bytes_hashed=0,
+        hash_time=0.0,
+        cached=False,
+        referenced=False,
+    ):
+        """
+        Writes the event of a layer, measured since the last call to 'mark'
+        or 'layer'.
+
+        kind: "base", "store" or "customisation".
+        bytes_hashed: Size of the layer tarball read by the first pass.
+        hash_time: Time the first pass took, or was waited for when it
+            ran concurrently, in seconds.
+        cached: Whether the checksum came from the checksum cache.
+        referenced: Whether the layer was only referred to.
+        """
+        elapsed = time.perf_counter() - self._time
+        size, files, read_time, write_time, copy_time = (
+            getattr(self.output, c) - before
+            for c, before in zip(self.counters, self._counters)
+        )
+        fields = {
+            "bytes_hashed": bytes_hashed,
+            "hash_time": hash_time,
+            "bytes_streamed": size,
+            "files": files,
+            "read_time": read_time,
+            "write_time": write_time,
+            "copy_time": copy_time,
+        }
+        for name, value in fields.items():
+            self.totals[name] += value
+        self.totals["layers"] += 1
+
+        other_time = (
+            elapsed - hash_time - read_time - write_time - copy_time
+        )
+        self.event(
+            "layer",
+            num=num,
+            kind=kind,
+            paths=paths,
+            cached=cached,
+            referenced=referenced,
+            **fields,
+            other_time=max(other_time, 0.0),
+            time=elapsed,
+        )
+        self.mark()
+
+    def close(self, **fields):
+        """
+        Writes the summary, with the totals of all layers and the given
+        fields, and closes the file.
+        """
+        elapsed = time.perf_counter() - self.start
+        self.event(
+            "summary",
+            **self.totals,
+            bytes_written=self.output.size,
+            **fields,
+            time=elapsed,
+        )
+        self.file.close()
+
+
+# 'members' maps the names of the members of the base image archive that
+# were read to their 'TarInfo'. 'path' is the path of the archive if it is
+# uncompressed, so that layers can be copied directly from their offset.
+FromImage = namedtuple(
+    "FromImage", ["tar", "manifest_json", "image_json", "members", "path"]
+)
 # Some metadata for a layer
-LayerInfo = namedtuple("LayerInfo", ["size", "checksum", "path", "paths"])
+LayerInfo = namedtuple(
+    "LayerInfo",
+    ["size", "checksum", "path", "paths", "descriptor"],
+    defaults=[None],
+)
+# Checksums and sizes of a layer tarball, and of the blob it is stored as,
+# which is the same unless the layer is compressed
+LayerDigest = namedtuple(
+    "LayerDigest", ["checksum", "size", "blob_checksum", "blob_size"]
+)
+
+OCI_LAYER_MEDIA_TYPES = {
+    None: "application/vnd.oci.image.layer.v1.tar",
+    "gzip": "application/vnd.oci.image.layer.v1.tar+gzip",
+    "zstd": "application/vnd.oci.image.layer.v1.tar+zstd",
+}
+OCI_CONFIG_MEDIA_TYPE = "application/vnd.oci.image.config.v1+json"
+OCI_MANIFEST_MEDIA_TYPE = "application/vnd.oci.image.manifest.v1+json"
+OCI_INDEX_MEDIA_TYPE = "application/vnd.oci.image.index.v1+json"
+
+
+def layer_path(layout, checksum):
+    """
+    Returns: The path of the layer tarball or blob with the given checksum
+             in the given image layout, "docker" or "oci".
+    """
+    if layout == "oci":
+        return f"blobs/sha256/{checksum}"
+    return f"{checksum}/layer.tar"
+
+
+def oci_descriptor(media_type, checksum, size):
+    """
+    Returns: An OCI content descriptor [3] as a 'dict'.
+    """
+    return {
+        "mediaType": media_type,
+        "digest": f"sha256:{checksum}",
+        "size": size,
+    }
 
 
 def load_from_image(from_image_str):
@@ -146,25 +1007,108 @@ def load_from_image(from_image_str):
     if from_image_str is None:
         return None
 
-    base_tar = tarfile.open(from_image_str)
-
-    manifest_json_tarinfo = base_tar.getmember("manifest.json")
-    with base_tar.extractfile(manifest_json_tarinfo) as f:
-        manifest_json = json.load(f)
-
-    image_json_tarinfo = base_tar.getmember(manifest_json[0]["Config"])
+    try:
+        base_tar = tarfile.open(from_image_str, "r:")
+        path = from_image_str
+    except tarfile.ReadError:
+        # Compressed archives have to be read through 'tarfile'.
+        base_tar = tarfile.open(from_image_str)
+        path = None
+
+    # Only read the headers until the manifest and everything it refers to
+    # have been found, rather than indexing the whole archive.
+    members = {}
+    manifest_json = None
+    for tarinfo in base_tar:
+        members[tarinfo.name] = tarinfo
+        if tarinfo.name == "manifest.json":
+            with base_tar.extractfile(tarinfo) as f:
+                manifest_json = json.load(f)
+        if manifest_json is not None:
+            needed = [manifest_json[0]["Config"], *manifest_json[0]["Layers"]]
+            if all(name in members for name in needed):
+                break
+
+    if manifest_json is None:
+        raise KeyError(f"manifest.json not found in {from_image_str}")
+
+    image_json_tarinfo = members[manifest_json[0]["Config"]]
     with base_tar.extractfile(image_json_tarinfo) as f:
         image_json = json.load(f)
 
-    return FromImage(base_tar, manifest_json, image_json)
+    return FromImage(base_tar, manifest_json, image_json, members, path)
+
+
+def load_digests(path):
+    """
+    Loads the checksums of the layers of a previously published image.
+
+    path: Path to its image configuration, its OCI image manifest or the
+          'manifest.json' of its extracted Docker image archive, or to a
+          file with one digest per line. The image configurations listed
+          in a 'manifest.json' are read from the same directory.
+
+    Returns: A set of hex-encoded sha256sums.
+    """
+    with open(path) as f:
+        content = f.read()
+
+    try:
+        document = json.loads(content)
+    except ValueError:
+        return {re.sub(r"^sha256:", "", line) for line in content.split()}
+
+    if isinstance(document, list):
+        # Docker 'manifest.json'. Layers are not always named after their
+        # diff_id, as with 'docker save' before Docker 25 or with
+        # '--single-pass', so these are read from the image configuration.
+        digests = []
+        for image in document:
+            config = os.path.join(os.path.dirname(path), image["Config"])
+            with open(config) as f:
+                digests += json.load(f)["rootfs"]["diff_ids"]
+        return {re.sub(r"^sha256:", "", digest) for digest in digests}
+
+    digests = document.get("rootfs", {}).get("diff_ids", [])
+    digests += [layer["digest"] for layer in document.get("layers", [])]
+    return {re.sub(r"^sha256:", "", digest) for digest in digests}
+
+
+def load_layer_descriptors(path):
+    """
+    Loads the layer descriptors of an image manifest, such as the one of an
+    image in a registry as printed by 'skopeo inspect --raw'.
+
+    path: Path to an OCI image manifest or a Docker image manifest V2,
+          schema 2, which have the same layer descriptors.
+
+    Returns: A list of OCI content descriptors as 'dict's.
+    """
+    with open(path) as f:
+        manifest = json.load(f)
+    if "layers" not in manifest:
+        raise ValueError(f"{path} is not an image manifest with layers")
+    return manifest["layers"]
 
 
-def add_base_layers(tar, from_image):
+def add_base_layers(
+    tar, from_image, layout="docker", reference=None, published=frozenset()
+):
     """
     Adds the layers from the given base image to the final image.
 
-    tar: 'tarfile.TarFile' object for new layers to be added to.
+    tar: 'TarWriter' object for new layers to be added to.
     from_image: 'FromImage' object with references to the loaded base image.
+    layout: "docker" or "oci". Docker layers keep their original path.
+    reference: Layer descriptors of the base image where it is published,
+               such as its registry, one for each of its layers, from
+               'load_layer_descriptors'. These
+               are copied to the OCI image manifest instead of adding the
+               blobs, since the published blobs are usually compressed.
+               The image can then only be copied to where the base image
+               already is.
+    published: Checksums of layers which were already published, which
+               are only referred to as well.
     """
     if from_image is None:
         print("No 'fromImage' provided", file=sys.stderr)
@@ -174,16 +1118,56 @@ def add_base_layers(tar, from_image):
     checksums = from_image.image_json["rootfs"]["diff_ids"]
     layers_checksums = zip(layers, checksums)
 
-    for num, (layer, checksum) in enumerate(layers_checksums, start=1):
-        layer_tarinfo = from_image.tar.getmember(layer)
-        checksum = re.sub(r"^sha256:", "", checksum)
-
-        tar.addfile(layer_tarinfo, from_image.tar.extractfile(layer_tarinfo))
-        path = layer_tarinfo.path
-        size = layer_tarinfo.size
-
-        print("Adding base layer", num, "from", path, file=sys.stderr)
-        yield LayerInfo(size=size, checksum=checksum, path=path, paths=[path])
+    with contextlib.ExitStack() as stack:
+        if from_image.path is not None and reference is None:
+            base_file = stack.enter_context(open(from_image.path, "rb"))
+
+        for num, (layer, checksum) in enumerate(layers_checksums, start=1):
+            layer_tarinfo = from_image.members[layer]
+            checksum = re.sub(r"^sha256:", "", checksum)
+
+            path = layer_tarinfo.path
+            size = layer_tarinfo.size
+
+            descriptor = None
+            if layout == "oci":
+                # Base image layers are uncompressed, so their checksum is
+                # also the checksum of the blob.
+                layer_tarinfo.name = layer_path(layout, checksum)
+                descriptor = oci_descriptor(
+                    OCI_LAYER_MEDIA_TYPES[None], checksum, size
+                )
+
+            if layout == "oci" and reference is not None:
+                descriptor = reference[num - 1]
+
+            if layout == "oci" and (
+                reference is not None or checksum in published
+            ):
+                print(
+                    "Referencing base layer",
+                    num,
+                    "from",
+                    path,
+                    file=sys.stderr,
+                )
+            else:
+                print("Adding base layer", num, "from", path, file=sys.stderr)
+                if from_image.path is not None:
+                    # Copied from its offset in the archive with 'sendfile'.
+                    base_file.seek(layer_tarinfo.offset_data)
+                    tar.addfile(layer_tarinfo, base_file)
+                else:
+                    f = from_image.tar.extractfile(layer_tarinfo)
+                    tar.addfile(layer_tarinfo, f)
+
+            yield LayerInfo(
+                size=size,
+                checksum=checksum,
+                path=layer_tarinfo.path,
+                paths=[path],
+                descriptor=descriptor,
+            )
 
     from_image.tar.close()
 
@@ -210,15 +1194,43 @@ def overlay_base_config(from_image, final_config):
     return final_config
 
 
-def add_layer_dir(tar, paths, store_dir, mtime, uid, gid, uname, gname):
+def add_layer_dir(
+    tar,
+    paths,
+    store_dir,
+    mtime,
+    uid,
+    gid,
+    uname,
+    gname,
+    digest=None,
+    single_pass=False,
+    layout="docker",
+    compression=None,
+    dedup=None,
+    reference=False,
+    blob_dir=None,
+):
     """
-    Appends given store paths to a TarFile object as a new layer.
+    Appends given store paths to a TarWriter object as a new layer.
 
-    tar: 'tarfile.TarFile' object for the new layer to be added to.
+    tar: 'TarWriter' object for the new layer to be added to.
     paths: List of store paths.
     store_dir: the root directory of the nix store
     mtime: 'mtime' of the added files and the layer tarball.
            Should be an integer representing a POSIX time.
+    digest: 'LayerDigest' object of the layer, if it is already known,
+            for example from a 'ChecksumCache'.
+    single_pass: Read the store paths only once. The checksum is then
+                 calculated while streaming the layer, so it cannot be part
+                 of the layer tarball's name.
+    layout: "docker" or "oci".
+    compression: 'None', "gzip" or "zstd". Only for the "oci" layout.
+    dedup: See 'layer_members'.
+    reference: Only refer to the layer in the OCI image manifest, without
+               adding its blob. Requires the digest to be known.
+    blob_dir: See 'layer_digest'. The compressed blob is copied from there
+              if it was kept, and removed afterwards.
 
     Returns: A 'LayerInfo' object containing some metadata of
              the layer added.
@@ -229,45 +1241,100 @@ def add_layer_dir(tar, paths, store_dir, mtime, uid, gid, uname, gname):
         len(invalid_paths) == 0
     ), f"Expecting absolute paths from {store_dir}, but got: {invalid_paths}"
 
-    # First, calculate the tarball checksum and the size.
-    extract_checksum = ExtractChecksum()
-    archive_paths_to(extract_checksum, paths, mtime, uid, gid, uname, gname)
-    (checksum, size) = extract_checksum.extract()
+    if digest is None and not single_pass:
+        # First, calculate the tarball checksum and the size.
+        digest = layer_digest(
+            paths, mtime, uid, gid, uname, gname, compression, dedup, blob_dir
+        )
+
+    if single_pass:
+        # Named after the key even if the checksum is known, so that the
+        # image does not depend on the state of the checksum cache.
+        key = layer_key(paths, mtime, uid, gid, uname, gname, dedup)
+        path = f"{key}/layer.tar"
+        if digest is None:
+            # The size only depends on the file metadata.
+            size = layer_tar_size(
+                paths, mtime, uid, gid, uname, gname, dedup
+            )
+        else:
+            size = digest.size
+    else:
+        path = layer_path(layout, digest.blob_checksum)
+        size = digest.blob_size
 
-    path = f"{checksum}/layer.tar"
     layer_tarinfo = tarfile.TarInfo(path)
     layer_tarinfo.size = size
     layer_tarinfo.mtime = mtime
 
-    # Then actually stream the contents to the outer tarball.
-    read_fd, write_fd = os.pipe()
-    with open(read_fd, "rb") as read, open(write_fd, "wb") as write:
-
-        def producer():
-            archive_paths_to(write, paths, mtime, uid, gid, uname, gname)
-            write.close()
+    blob = None
+    if blob_dir is not None and digest is not None:
+        blob = os.path.join(blob_dir, digest.blob_checksum)
+        if not os.path.exists(blob):
+            blob = None
 
-        # Closing the write end of the fifo also closes the read end,
-        # so we don't need to wait until this thread is finished.
-        #
-        # Any exception from the thread will get printed by the default
-        # exception handler, and the 'addfile' call will fail since it
-        # won't be able to read required amount of bytes.
-        threading.Thread(target=producer).start()
-        tar.addfile(layer_tarinfo, read)
+    # Then actually stream the contents to the outer tarball.
+    if blob is not None:
+        if not reference:
+            with open(blob, "rb") as f:
+                tar.addfile(layer_tarinfo, f)
+        os.remove(blob)
+    elif not reference:
+        with tar.addmember(layer_tarinfo) as fd_output:
+            output = fd_output
+            if compression is not None:
+                output = CompressOutput(output, compressor(compression))
+            if digest is None:
+                output.checksum = ExtractChecksum()
+            with TarWriter(output) as layer_tar:
+                add_paths_to(
+                    layer_tar, paths, mtime, uid, gid, uname, gname, dedup
+                )
+            if compression is not None:
+                output.finish()
+                fd_output.files += output.files
+                fd_output.read_time += output.read_time
+            if digest is None:
+                (checksum, size) = output.checksum.extract()
+                digest = LayerDigest(checksum, size, checksum, size)
+                output.checksum = None
+
+    descriptor = None
+    if layout == "oci":
+        descriptor = oci_descriptor(
+            OCI_LAYER_MEDIA_TYPES[compression],
+            digest.blob_checksum,
+            digest.blob_size,
+        )
 
-    return LayerInfo(size=size, checksum=checksum, path=path, paths=paths)
+    return LayerInfo(
+        size=digest.size,
+        checksum=digest.checksum,
+        path=path,
+        paths=paths,
+        descriptor=descriptor,
+    )
 
 
-def add_customisation_layer(target_tar, customisation_layer, mtime):
+def add_customisation_layer(
+    target_tar,
+    customisation_layer,
+    mtime,
+    layout="docker",
+    published=frozenset(),
+):
     """
     Adds the customisation layer as a new layer. This is layer is structured
     differently; given store path has the 'layer.tar' and corresponding
     sha256sum ready.
 
-    tar: 'tarfile.TarFile' object for the new layer to be added to.
+    tar: 'TarWriter' object for the new layer to be added to.
     customisation_layer: Path containing the layer archive.
     mtime: 'mtime' of the added layer tarball.
+    layout: "docker" or "oci".
+    published: Checksums of layers which were already published. In the
+               "oci" layout, they are only referred to in the manifest,
+               without adding their blob.
     """
 
     checksum_path = os.path.join(customisation_layer, "checksum")
@@ -275,18 +1342,29 @@ def add_customisation_layer(target_tar, customisation_layer, mtime):
         checksum = f.read().strip()
     assert len(checksum) == 64, f"Invalid sha256 at ${checksum_path}."
 
-    layer_path = os.path.join(customisation_layer, "layer.tar")
+    archive_path = os.path.join(customisation_layer, "layer.tar")
 
-    path = f"{checksum}/layer.tar"
-    tarinfo = target_tar.gettarinfo(layer_path)
+    path = layer_path(layout, checksum)
+    tarinfo = target_tar.gettarinfo(archive_path)
     tarinfo.name = path
     tarinfo.mtime = mtime
 
-    with open(layer_path, "rb") as f:
-        target_tar.addfile(tarinfo, f)
+    if layout != "oci" or checksum not in published:
+        with open(archive_path, "rb") as f:
+            target_tar.addfile(tarinfo, f)
+
+    descriptor = None
+    if layout == "oci":
+        descriptor = oci_descriptor(
+            OCI_LAYER_MEDIA_TYPES[None], checksum, tarinfo.size
+        )
 
     return LayerInfo(
-        size=None, checksum=checksum, path=path, paths=[customisation_layer]
+        size=tarinfo.size,
+        checksum=checksum,
+        path=path,
+        paths=[customisation_layer],
+        descriptor=descriptor,
     )
 
 
@@ -294,7 +1372,7 @@ def add_bytes(tar, path, content, mtime):
     """
     Adds a file to the tarball with given path and contents.
 
-    tar: 'tarfile.TarFile' object.
+    tar: 'TarWriter' object.
     path: Path of the file as a string.
     content: Contents of the file.
     mtime: 'mtime' of the file. Should be an integer representing a POSIX time.
@@ -307,9 +1385,254 @@ def add_bytes(tar, path, content, mtime):
     tar.addfile(ti, io.BytesIO(content))
 
 
+def add_oci_layout(tar, mtime):
+    """
+    Adds the 'oci-layout' file and the blob directories of an OCI image
+    layout [3].
+
+    tar: 'TarWriter' object.
+    mtime: 'mtime' of the files. Should be an integer representing a POSIX
+           time.
+    """
+    for path in ["blobs", "blobs/sha256"]:
+        ti = tarfile.TarInfo(path)
+        ti.type = tarfile.DIRTYPE
+        ti.mode = 0o0755  # rwxr-xr-x
+        ti.mtime = mtime
+        tar.addfile(ti)
+
+    oci_layout = json.dumps({"imageLayoutVersion": "1.0.0"}).encode("utf-8")
+    add_bytes(tar, "oci-layout", oci_layout, mtime=mtime)
+
+
+def add_blob(tar, media_type, content, mtime):
+    """
+    Adds a blob with the given contents to an OCI image layout.
+
+    tar: 'TarWriter' object.
+    media_type: Media type of the blob.
+    content: Contents of the blob.
+    mtime: 'mtime' of the file. Should be an integer representing a POSIX time.
+
+    Returns: The OCI content descriptor of the blob.
+    """
+    checksum = hashlib.sha256(content).hexdigest()
+    add_bytes(tar, f"blobs/sha256/{checksum}", content, mtime=mtime)
+    return oci_descriptor(media_type, checksum, len(content))
+
+
+def add_oci_index(tar, image_json, layers, repo_tag, mtime):
+    """
+    Adds the image configuration, the image manifest and the index of an
+    OCI image layout.
+
+    tar: 'TarWriter' object.
+    image_json: Image configuration, as bytes.
+    layers: List of 'LayerInfo' objects with an OCI descriptor.
+    repo_tag: Name and tag of the image.
+    mtime: 'mtime' of the files. Should be an integer representing a POSIX
+           time.
+    """
+    config = add_blob(tar, OCI_CONFIG_MEDIA_TYPE, image_json, mtime)
+
+    manifest = {
+        "schemaVersion": 2,
+        "mediaType": OCI_MANIFEST_MEDIA_TYPE,
+        "config": config,
+        "layers": [layer.descriptor for layer in layers],
+    }
+    manifest = json.dumps(manifest, indent=4).encode("utf-8")
+    manifest = add_blob(tar, OCI_MANIFEST_MEDIA_TYPE, manifest, mtime)
+
+    tag = repo_tag.rsplit("/", 1)[-1].partition(":")[2] or "latest"
+    manifest["annotations"] = {
+        "io.containerd.image.name": repo_tag,
+        "org.opencontainers.image.ref.name": tag,
+    }
+    index = {
+        "schemaVersion": 2,
+        "mediaType": OCI_INDEX_MEDIA_TYPE,
+        "manifests": [manifest],
+    }
+    index = json.dumps(index, indent=4).encode("utf-8")
+    add_bytes(tar, "index.json", index, mtime=mtime)
+
+
+def write_changed_layers(path, layers, published):
+    """
+    Writes the layers which were not already published, and so need to be
+    uploaded, to a JSON file.
+
+    path: Path of the JSON file.
+    layers: List of 'LayerInfo' objects.
+    published: Checksums of layers which were already published.
+    """
+    changed = []
+    for layer in layers:
+        if layer.descriptor is not None:
+            digest = layer.descriptor["digest"]
+            size = layer.descriptor["size"]
+        else:
+            digest = f"sha256:{layer.checksum}"
+            size = layer.size
+        if re.sub(r"^sha256:", "", digest) not in published:
+            changed.append(
+                {
+                    "digest": digest,
+                    "size": size,
+                    "diff_id": f"sha256:{layer.checksum}",
+                    "paths": layer.paths,
+                }
+            )
+
+    with open(path, "w") as f:
+        json.dump(changed, f, indent=4)
+
+
 now = datetime.now(tz=timezone.utc)
 
 
+def plan_image(
+    conf,
+    from_image,
+    mtime,
+    uid,
+    gid,
+    uname,
+    gname,
+    digests=False,
+    jobs=1,
+    cache=None,
+    compression=None,
+    dedup=None,
+):
+    """
+    Describes the layers of the image from the metadata of the store paths,
+    without writing it.
+
+    conf: The parsed configuration file.
+    from_image: 'FromImage' object of the base image, or 'None'.
+    digests: Also calculate the checksums of the store layers, which reads
+             their contents. Cached checksums are used if possible.
+    jobs: Number of layers to calculate the checksum of concurrently.
+    cache: 'ChecksumCache' object, or 'None'.
+    compression: 'None', "gzip" or "zstd".
+    dedup: See 'layer_members'.
+
+    Returns: A 'dict' with the size and checksum of each layer, the number
+             of files in the store layers, their total and timings.
+    """
+    start = time.perf_counter()
+    layers = []
+
+    if from_image is not None:
+        names = from_image.manifest_json[0]["Layers"]
+        checksums = from_image.image_json["rootfs"]["diff_ids"]
+        for name, checksum in zip(names, checksums):
+            layers.append(
+                {
+                    "kind": "base",
+                    "paths": [name],
+                    "size": from_image.members[name].size,
+                    "checksum": re.sub(r"^sha256:", "", checksum),
+                }
+            )
+        from_image.tar.close()
+
+    store_layers = conf["store_layers"]
+    for store_layer in store_layers:
+        stats = layer_stats(
+            store_layer, mtime, uid, gid, uname, gname, dedup
+        )
+        layers.append({"kind": "store", "paths": store_layer, **stats})
+    scanned = time.perf_counter()
+
+    if digests:
+        keys = [
+            layer_key(store_layer, mtime, uid, gid, uname, gname, dedup)
+            for store_layer in store_layers
+        ]
+        if cache:
+            store_digests = [cache.get(key, compression) for key in keys]
+        else:
+            store_digests = [None] * len(store_layers)
+
+        missing = [
+            num for num, digest in enumerate(store_digests) if not digest
+        ]
+        missing_layers = [store_layers[num] for num in missing]
+        if jobs > 1 and missing:
+            missing_digests = layer_digests(
+                missing_layers,
+                mtime,
+                uid,
+                gid,
+                uname,
+                gname,
+                jobs,
+                compression,
+                dedup,
+            )
+        else:
+            missing_digests = [
+                layer_digest(
+                    store_layer,
+                    mtime,
+                    uid,
+                    gid,
+                    uname,
+                    gname,
+                    compression,
+                    dedup,
+                )
+                for store_layer in missing_layers
+            ]
+        for num, digest in zip(missing, missing_digests):
+            store_digests[num] = digest
+            if cache:
+                cache.put(keys[num], digest, compression)
+
+        store = [layer for layer in layers if layer["kind"] == "store"]
+        for layer, digest in zip(store, store_digests):
+            layer["checksum"] = digest.checksum
+            if compression:
+                layer["blob_checksum"] = digest.blob_checksum
+                layer["blob_size"] = digest.blob_size
+    hashed = time.perf_counter()
+
+    customisation_layer = conf["customisation_layer"]
+    with open(os.path.join(customisation_layer, "checksum")) as f:
+        checksum = f.read().strip()
+    archive_path = os.path.join(customisation_layer, "layer.tar")
+    layers.append(
+        {
+            "kind": "customisation",
+            "paths": [customisation_layer],
+            "size": os.stat(archive_path).st_size,
+            "checksum": checksum,
+        }
+    )
+
+    store = [layer for layer in layers if layer["kind"] == "store"]
+    plan = {
+        "layers": layers,
+        "size": sum(layer["size"] for layer in layers),
+        "entries": sum(layer["entries"] for layer in store),
+        "files": sum(layer["files"] for layer in store),
+        "file_bytes": sum(layer["file_bytes"] for layer in store),
+    }
+    if digests and compression:
+        plan["blob_size"] = sum(
+            layer.get("blob_size", layer["size"]) for layer in layers
+        )
+    plan["timings"] = {
+        "scan": scanned - start,
+        "digests": hashed - scanned,
+        "total": time.perf_counter() - start,
+    }
+    return plan
+
+
 def parse_time(s):
     if s == "now":
         return now
@@ -346,8 +1669,142 @@ Docker Image Specification v1.2 as reference [1].
         "--repo_tag", "-t", type=str,
         help="Override the RepoTags from the configuration"
     )
+    arg_parser.add_argument(
+        "--single-pass",
+        action="store_true",
+        help="""
+        Read the store paths only once, calculating the size of each layer
+        from the file metadata and its checksum while streaming it. Layers
+        are then named after their store paths instead of their checksum.
+        """,
+    )
+    arg_parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="""
+        Number of layers to calculate the checksum of concurrently, before
+        streaming the image. The output does not depend on this value.
+        """,
+    )
+    arg_parser.add_argument(
+        "--cache-dir",
+        nargs="?",
+        const=default_cache_dir(),
+        default=os.environ.get("STREAM_LAYERED_IMAGE_CACHE_DIR") or None,
+        help="""
+        Keep the checksum and size of the tarball of each store layer in
+        this directory, keyed by its store paths, so that rebuilding an
+        image only hashes the layers that changed. Without a value,
+        $XDG_CACHE_HOME/stream_layered_image is used, and
+        $STREAM_LAYERED_IMAGE_CACHE_DIR sets a default.
+        """,
+    )
+    arg_parser.add_argument(
+        "--format",
+        choices=["docker", "oci"],
+        default="docker",
+        help="""
+        Write the image as a Docker image archive, or as an OCI image
+        layout with the layers in 'blobs/sha256'.
+        """,
+    )
+    arg_parser.add_argument(
+        "--compression",
+        choices=["gzip", "zstd"] if zstd else ["gzip"],
+        help="""
+        Compress the store layers of an OCI image layout. The checksums of
+        the compressed blobs are calculated along with the checksums of the
+        layers, concurrently with '--jobs'. zstd requires Python 3.14.
+        Compressed blobs are kept in $TMPDIR until they are written, so
+        that they are not compressed twice, which takes up to the size of
+        '--jobs' + 1 compressed layers on disk.
+        """,
+    )
+
+    arg_parser.add_argument(
+        "--reference-base-layers",
+        metavar="MANIFEST",
+        help="""
+        Only refer to the layers of the base image in the manifest of an
+        OCI image layout, without adding their blobs, using the layer
+        descriptors of this image manifest of the base image in its
+        registry, as printed by 'skopeo inspect --raw'. Such an image can
+        only be copied to a registry which already has the base image.
+        """,
+    )
+
+    arg_parser.add_argument(
+        "--dedup",
+        choices=["hardlinks", "content"],
+        help="""
+        Archive hardlinks within a layer as hardlinks rather than copies of
+        the file. With "content", regular files with the same contents and
+        mode are archived as hardlinks as well. Unlike "hardlinks", which
+        depends on whether the store was optimised, its output only
+        depends on the contents of the store paths.
+        """,
+    )
+
+    arg_parser.add_argument(
+        "--previous",
+        help="""
+        Image configuration, OCI image manifest or Docker 'manifest.json' of
+        a previously published image, or a file with one layer digest per
+        line. A 'manifest.json' must be next to the image configuration it
+        lists, as in an extracted Docker image archive. In an OCI image
+        layout, the layers it already has are only referred to in the
+        manifest, without adding their blobs. A Docker image archive still
+        contains every layer. Compressed layers only match the digests of
+        their blobs, as listed by an OCI image manifest, and not their
+        diff_ids.
+        """,
+    )
+    arg_parser.add_argument(
+        "--changed-layers",
+        metavar="FILE",
+        help="""
+        Write the digests, sizes and store paths of the layers which are
+        not in '--previous', and so need to be uploaded, to this JSON file.
+        """,
+    )
+
+    arg_parser.add_argument(
+        "--metrics",
+        metavar="FILE",
+        help="""
+        Write an event to this file as a JSON line once each layer has been
+        written, with the bytes hashed and streamed, the files copied, the
+        time spent reading them and blocked writing the image, and the time
+        spent copying them with sendfile(2), then a summary of the whole
+        image.
+        """,
+    )
+    arg_parser.add_argument(
+        "--plan",
+        nargs="?",
+        choices=["sizes", "digests"],
+        const="sizes",
+        help="""
+        Write a JSON description of the image to stdout instead of the
+        image: the exact size of every layer tarball, the number of files
+        in the store layers and their total, along with timings. Only file
+        metadata is read, unless given "digests", which also calculates the
+        checksums of the store layers like the first pass would, using
+        '--jobs' and '--cache-dir'.
+        """,
+    )
 
     args = arg_parser.parse_args()
+    if args.compression and args.format != "oci":
+        arg_parser.error("--compression requires --format=oci")
+    if args.reference_base_layers and args.format != "oci":
+        arg_parser.error("--reference-base-layers requires --format=oci")
+    if args.single_pass and args.format == "oci":
+        arg_parser.error("--single-pass is not supported with --format=oci")
+    if args.single_pass and args.previous:
+        arg_parser.error("--single-pass is not supported with --previous")
     with open(args.conf, "r") as f:
         conf = json.load(f)
 
@@ -360,24 +1817,208 @@ Docker Image Specification v1.2 as reference [1].
     store_dir = conf["store_dir"]
 
     from_image = load_from_image(conf["from_image"])
+    published = load_digests(args.previous) if args.previous else frozenset()
+    base_descriptors = None
+    if args.reference_base_layers:
+        base_descriptors = load_layer_descriptors(args.reference_base_layers)
+        if from_image is not None:
+            count = len(from_image.image_json["rootfs"]["diff_ids"])
+            if len(base_descriptors) != count:
+                arg_parser.error(
+                    f"the base image has {count} layers, but"
+                    f" --reference-base-layers has {len(base_descriptors)}"
+                )
+
+    if args.plan:
+        plan = plan_image(
+            conf,
+            from_image,
+            mtime,
+            uid,
+            gid,
+            uname,
+            gname,
+            digests=args.plan == "digests",
+            jobs=args.jobs,
+            cache=ChecksumCache(args.cache_dir) if args.cache_dir else None,
+            compression=args.compression,
+            dedup=args.dedup,
+        )
+        json.dump(plan, sys.stdout, indent=4)
+        print()
+        return
+
+    # Compressed blobs are kept from the first pass, rather than compressed
+    # again while streaming them.
+    blobs = contextlib.nullcontext()
+    if args.compression:
+        blobs = tempfile.TemporaryDirectory(prefix="stream_layered_image-")
+
+    with (
+        TarWriter(FdOutput(sys.stdout.fileno())) as tar,
+        blobs as blob_dir,
+        contextlib.ExitStack() as stack,
+    ):
+        metrics = None
+        if args.metrics:
+            metrics = Metrics(args.metrics, tar.output)
+
+        if args.format == "oci":
+            add_oci_layout(tar, mtime)
 
-    with tarfile.open(mode="w|", fileobj=sys.stdout.buffer) as tar:
         layers = []
-        layers.extend(add_base_layers(tar, from_image))
+        if metrics:
+            metrics.mark()
+        base_layers = add_base_layers(
+            tar,
+            from_image,
+            args.format,
+            reference=base_descriptors,
+            published=published,
+        )
+        for info in base_layers:
+            layers.append(info)
+            if metrics:
+                metrics.layer(
+                    len(layers),
+                    "base",
+                    info.paths,
+                    referenced=args.format == "oci"
+                    and (
+                        base_descriptors is not None
+                        or info.checksum in published
+                    ),
+                )
+
+        store_layers = conf["store_layers"]
+        keys = [
+            layer_key(store_layer, mtime, uid, gid, uname, gname, args.dedup)
+            for store_layer in store_layers
+        ]
+
+        cache = ChecksumCache(args.cache_dir) if args.cache_dir else None
+        if cache:
+            digests = [cache.get(key, args.compression) for key in keys]
+        else:
+            digests = [None] * len(store_layers)
+
+        missing = [num for num, digest in enumerate(digests) if not digest]
+        cached = [digest is not None for digest in digests]
+        parallel = args.jobs > 1 and not args.single_pass and missing
+        parallel_hash_time = 0.0
+        if parallel:
+            print(
+                "Calculating checksums of",
+                len(missing),
+                "layers with",
+                args.jobs,
+                "jobs...",
+                file=sys.stderr,
+            )
+            # Closed before 'blob_dir' is removed, so that no worker is
+            # still writing to it.
+            missing_digests = stack.enter_context(
+                contextlib.closing(
+                    iter_layer_digests(
+                        [store_layers[num] for num in missing],
+                        mtime,
+                        uid,
+                        gid,
+                        uname,
+                        gname,
+                        args.jobs,
+                        args.compression,
+                        args.dedup,
+                        blob_dir,
+                    )
+                )
+            )
 
+        if metrics:
+            metrics.mark()
         start = len(layers) + 1
-        for num, store_layer in enumerate(conf["store_layers"], start=start):
+        for num, (store_layer, key, digest) in enumerate(
+            zip(store_layers, keys, digests), start=start
+        ):
+            bytes_hashed = 0
+            hash_time = 0.0
+            if digest is None and parallel:
+                # The layer was hashed concurrently, while the previous
+                # layers were streamed. Only the time waiting for it counts.
+                hash_start = time.perf_counter()
+                digest = next(missing_digests)
+                hash_time = time.perf_counter() - hash_start
+                parallel_hash_time += hash_time
+                bytes_hashed = digest.size
+                if cache:
+                    cache.put(key, digest, args.compression)
+            if digest is None and not args.single_pass:
+                hash_start = time.perf_counter()
+                digest = layer_digest(
+                    store_layer,
+                    mtime,
+                    uid,
+                    gid,
+                    uname,
+                    gname,
+                    args.compression,
+                    args.dedup,
+                    blob_dir,
+                )
+                hash_time = time.perf_counter() - hash_start
+                bytes_hashed = digest.size
+                if cache:
+                    cache.put(key, digest, args.compression)
+
+            # Only the blob itself can be referred to. A compressed layer
+            # with a published diff_id may have been compressed differently.
+            reference = (
+                args.format == "oci"
+                and digest.blob_checksum in published
+            )
             print(
-                "Creating layer",
+                "Referencing" if reference else "Creating",
+                "layer",
                 num,
                 "from paths:",
                 store_layer,
                 file=sys.stderr,
             )
             info = add_layer_dir(
-                tar, store_layer, store_dir, mtime, uid, gid, uname, gname
+                tar,
+                store_layer,
+                store_dir,
+                mtime,
+                uid,
+                gid,
+                uname,
+                gname,
+                digest=digest,
+                single_pass=args.single_pass,
+                layout=args.format,
+                compression=args.compression,
+                dedup=args.dedup,
+                reference=reference,
+                blob_dir=blob_dir,
             )
+            if cache and digest is None:
+                # With '--single-pass', the checksum is only known once the
+                # layer has been streamed.
+                digest = LayerDigest(
+                    info.checksum, info.size, info.checksum, info.size
+                )
+                cache.put(key, digest)
             layers.append(info)
+            if metrics:
+                metrics.layer(
+                    num,
+                    "store",
+                    store_layer,
+                    bytes_hashed=bytes_hashed,
+                    hash_time=hash_time,
+                    cached=cached[num - start],
+                    referenced=reference,
+                )
 
         print(
             "Creating layer",
@@ -387,9 +2028,32 @@ Docker Image Specification v1.2 as reference [1].
         )
         layers.append(
             add_customisation_layer(
-                tar, conf["customisation_layer"], mtime=mtime
+                tar,
+                conf["customisation_layer"],
+                mtime=mtime,
+                layout=args.format,
+                published=published,
             )
         )
+        if metrics:
+            metrics.layer(
+                len(layers),
+                "customisation",
+                layers[-1].paths,
+                referenced=args.format == "oci"
+                and layers[-1].checksum in published,
+            )
+
+        if cache:
+            print(
+                "Found the checksums of",
+                cache.hits,
+                "of",
+                cache.hits + cache.misses,
+                "store layers in",
+                args.cache_dir,
+                file=sys.stderr,
+            )
 
         print("Adding manifests...", file=sys.stderr)
 
@@ -412,22 +2076,40 @@ Docker Image Specification v1.2 as reference [1].
         }
 
         image_json = json.dumps(image_json, indent=4).encode("utf-8")
-        image_json_checksum = hashlib.sha256(image_json).hexdigest()
-        image_json_path = f"{image_json_checksum}.json"
-        add_bytes(tar, image_json_path, image_json, mtime=mtime)
-
-        manifest_json = [
-            {
-                "Config": image_json_path,
-                "RepoTags": [args.repo_tag or conf["repo_tag"]],
-                "Layers": [layer.path for layer in layers],
-            }
-        ]
-        manifest_json = json.dumps(manifest_json, indent=4).encode("utf-8")
-        add_bytes(tar, "manifest.json", manifest_json, mtime=mtime)
+        repo_tag = args.repo_tag or conf["repo_tag"]
+
+        if args.format == "oci":
+            add_oci_index(tar, image_json, layers, repo_tag, mtime)
+        else:
+            image_json_checksum = hashlib.sha256(image_json).hexdigest()
+            image_json_path = f"{image_json_checksum}.json"
+            add_bytes(tar, image_json_path, image_json, mtime=mtime)
+
+            manifest_json = [
+                {
+                    "Config": image_json_path,
+                    "RepoTags": [repo_tag],
+                    "Layers": [layer.path for layer in layers],
+                }
+            ]
+            manifest_json = json.dumps(manifest_json, indent=4)
+            add_bytes(
+                tar, "manifest.json", manifest_json.encode("utf-8"), mtime
+            )
+
+        if args.changed_layers:
+            write_changed_layers(args.changed_layers, layers, published)
 
         print("Done.", file=sys.stderr)
 
+    if metrics:
+        # After closing the image, which writes its last bytes.
+        metrics.close(
+            parallel_hash_time=parallel_hash_time,
+            cache_hits=cache.hits if cache else 0,
+            cache_misses=cache.misses if cache else 0,
+        )
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks auto-patchelf on synthetic trees of ELF files.
+
+The trees are generated from scratch by this script, so it runs offline on
+any Linux machine with Python and pyelftools, without a compiler. Every
+parameter of the tree is seeded, so the same arguments always produce the
+same tree:
+
+* a dynamic linker and a libc directory the patched files are targeted at,
+* --libs shared libraries spread over a chain of --rpath-depth library
+  directories, each one pointing at the next with its RUNPATH, so that
+  populate_cache has to follow them,
+* an output tree of --files executables and libraries, each needing
+  --needed libraries, a share of which carry a .note.dlopen note, mixed
+  with symlinks and non-ELF data files.
+
+patchelf is replaced by a stub that only counts its invocations, so that
+the measurements are those of auto-patchelf itself. Pass --real-patchelf to
+run the patchelf found in PATH instead.
+
+Three things are measured, each --repeat times on a fresh tree:
+
+* populate_cache over the output and library directories,
+* auto_patchelf_file over every file of the output tree, serially,
+* a full auto-patchelf run in a separate process, with its wall time, peak
+  RSS and patchelf invocation count.
+
+The results are printed as JSON, so they can be stored and compared over
+time.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional
+
+
+AUTO_PATCHELF = Path(__file__).resolve().parent.parent / "source" / "auto-patchelf.py"
+
+INTERPRETER = "/lib64/ld-linux-x86-64.so.2"
+
+ET_DYN = 3
+EM_X86_64 = 62
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+PT_NOTE = 4
+SHT_PROGBITS = 1
+SHT_STRTAB = 3
+SHT_DYNAMIC = 6
+SHT_NOTE = 7
+SHF_ALLOC = 2
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_STRSZ = 10
+DT_SONAME = 14
+DT_RUNPATH = 29
+NT_FDO_DLOPEN = 0x407C0C0A
+
+BASE_ADDRESS = 0x400000
+
+
+def align(value: int, alignment: int) -> int:
+    return (value + alignment - 1) & ~(alignment - 1)
+
+
+def make_elf(needed: list[str] = [],
+             soname: Optional[str] = None,
+             runpath: Optional[str] = None,
+             interpreter: Optional[str] = None,
+             dlopen: list[list[str]] = []) -> bytes:
+    """
+    Builds a minimal x86-64 ELF shared object or position-independent
+    executable. It only holds what auto-patchelf and patchelf look at: the
+    interpreter, the dynamic section with its string table, and an optional
+    .note.dlopen note.
+    """
+    dynstr = bytearray(b"\0")
+
+    def add_string(s: str) -> int:
+        offset = len(dynstr)
+        dynstr.extend(s.encode() + b"\0")
+        return offset
+
+    dynamic_entries = [(DT_NEEDED, add_string(name)) for name in needed]
+    if soname is not None:
+        dynamic_entries.append((DT_SONAME, add_string(soname)))
+    if runpath is not None:
+        dynamic_entries.append((DT_RUNPATH, add_string(runpath)))
+
+    note = b""
+    if dlopen:
+        desc = json.dumps([{"feature": f"feature{i}", "soname": sonames}
+                           for i, sonames in enumerate(dlopen)]).encode() + b"\0"
+        note = (struct.pack("<III", 4, len(desc), NT_FDO_DLOPEN) + b"FDO\0"
+                + desc.ljust(align(len(desc), 4), b"\0"))
+
+    # Program headers come right after the ELF header.
+    segments = [PT_LOAD, PT_DYNAMIC]
+    if interpreter is not None:
+        segments.insert(0, PT_INTERP)
+    if note:
+        segments.append(PT_NOTE)
+    offset = 64 + 56 * len(segments)
+
+    # Section contents, as (name, type, flags, alignment, entsize, contents)
+    sections = []
+    if interpreter is not None:
+        sections.append((".interp", SHT_PROGBITS, SHF_ALLOC, 1, 0, interpreter.encode() + b"\0"))
+    sections.append((".dynstr", SHT_STRTAB, SHF_ALLOC, 1, 0, None))
+    sections.append((".dynamic", SHT_DYNAMIC, SHF_ALLOC, 8, 16, None))
+    if note:
+        sections.append((".note.dlopen", SHT_NOTE, SHF_ALLOC, 4, 0, note))
+
+    shstrtab = bytearray(b"\0")
+    name_offsets = {}
+    for name in [s[0] for s in sections] + [".shstrtab"]:
+        name_offsets[name] = len(shstrtab)
+        shstrtab.extend(name.encode() + b"\0")
+
+    # The dynamic section refers to the string table by address, so lay out
+    # the sections once to find out where .dynstr ends up.
+    layout = {}
+    position = offset
+    for name, _, _, alignment, _, contents in sections:
+        position = align(position, alignment)
+        if name == ".dynstr":
+            size = len(dynstr)
+        elif name == ".dynamic":
+            size = 16 * (len(dynamic_entries) + 3)
+        else:
+            size = len(contents)
+        layout[name] = (position, size)
+        position += size
+
+    dynstr_offset, _ = layout[".dynstr"]
+    dynamic_entries += [(DT_STRTAB, BASE_ADDRESS + dynstr_offset), (DT_STRSZ, len(dynstr)), (DT_NULL, 0)]
+    dynamic = b"".join(struct.pack("<qQ", tag, value) for tag, value in dynamic_entries)
+
+    body = bytearray(offset)
+    for name, _, _, _, _, contents in sections:
+        section_offset, _ = layout[name]
+        if name == ".dynstr":
+            contents = bytes(dynstr)
+        elif name == ".dynamic":
+            contents = dynamic
+        body.extend(b"\0" * (section_offset - len(body)))
+        body.extend(contents)
+
+    shstrtab_offset = len(body)
+    body.extend(shstrtab)
+    shoff = align(len(body), 8)
+    body.extend(b"\0" * (shoff - len(body)))
+
+    # Section headers
+    headers = [struct.pack("<IIQQQQIIQQ", 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)]
+    dynstr_index = 1 + [s[0] for s in sections].index(".dynstr")
+    for name, sh_type, flags, alignment, entsize, _ in sections:
+        section_offset, size = layout[name]
+        link = dynstr_index if sh_type == SHT_DYNAMIC else 0
+        headers.append(struct.pack("<IIQQQQIIQQ", name_offsets[name], sh_type, flags,
+                                   BASE_ADDRESS + section_offset, section_offset, size,
+                                   link, 0, alignment, entsize))
+    headers.append(struct.pack("<IIQQQQIIQQ", name_offsets[".shstrtab"], SHT_STRTAB, 0, 0,
+                               shstrtab_offset, len(shstrtab), 0, 0, 1, 0))
+    body.extend(b"".join(headers))
+
+    # Program headers
+    phdrs = []
+    for p_type in segments:
+        if p_type == PT_INTERP:
+            p_offset, p_size = layout[".interp"]
+        elif p_type == PT_DYNAMIC:
+            p_offset, p_size = layout[".dynamic"]
+        elif p_type == PT_NOTE:
+            p_offset, p_size = layout[".note.dlopen"]
+        else:
+            p_offset, p_size = 0, len(body)
+        p_align = 0x1000 if p_type == PT_LOAD else 8
+        phdrs.append(struct.pack("<IIQQQQQQ", p_type, 4, p_offset, BASE_ADDRESS + p_offset,
+                                 BASE_ADDRESS + p_offset, p_size, p_size, p_align))
+    body[64:offset] = b"".join(phdrs)
+
+    ident = b"\x7fELF" + bytes([2, 1, 1, 0]) + bytes(8)
+    body[:64] = ident + struct.pack("<HHIQQQIHHHHHH", ET_DYN, EM_X86_64, 1, 0, 64, shoff, 0,
+                                    64, 56, len(segments), 64, len(headers), len(headers) - 1)
+    return bytes(body)
+
+
+def generate_tree(root: Path, args: argparse.Namespace) -> dict:
+    """
+    Generates a synthetic tree under root and returns the paths auto-patchelf
+    should be run with.
+    """
+    rng = random.Random(args.seed)
+    root.mkdir(parents=True)
+
+    interpreter = root / "ld-linux-x86-64.so.2"
+    interpreter.write_bytes(make_elf(soname="ld-linux-x86-64.so.2"))
+    libc_lib = root / "libc" / "lib"
+    libc_lib.mkdir(parents=True)
+    (libc_lib / "libc.so.6").write_bytes(make_elf(soname="libc.so.6"))
+
+    depth = max(args.rpath_depth, 1)
+    lib_dirs = [root / "deps" / f"dep{d}" / "lib" for d in range(depth)]
+    for lib_dir in lib_dirs:
+        lib_dir.mkdir(parents=True)
+
+    sonames = []
+    for i in range(args.libs):
+        d = i % depth
+        soname = f"libbench{i}.so.1"
+        runpath = lib_dirs[d + 1].as_posix() if d + 1 < depth else None
+        (lib_dirs[d] / soname).write_bytes(make_elf(["libc.so.6"], soname=soname, runpath=runpath))
+        if rng.random() < args.symlink_ratio:
+            (lib_dirs[d] / f"libbench{i}.so").symlink_to(soname)
+        sonames.append(soname)
+
+    out = root / "out"
+    elf_paths = []
+    for i in range(args.files):
+        # Spread the files over a few nested directories, like real outputs.
+        if i % 4 == 0:
+            path = out / "lib" / f"libout{i}.so"
+        else:
+            path = out / "bin" / f"sub{i % 7}" / f"prog{i}"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        needed = rng.sample(sonames, min(args.needed, len(sonames))) + ["libc.so.6"]
+        dlopen = []
+        if rng.random() < args.dlopen_ratio:
+            dlopen = [["libmissing.so.0", rng.choice(sonames)]]
+        path.write_bytes(make_elf(
+            needed,
+            soname=path.name if path.suffix == ".so" else None,
+            runpath="/build/source/lib",
+            interpreter=None if path.suffix == ".so" else INTERPRETER,
+            dlopen=dlopen))
+        path.chmod(0o755)
+        elf_paths.append(path)
+
+        if rng.random() < args.symlink_ratio:
+            link = path.with_name(path.name + "-link")
+            link.symlink_to(path.name)
+
+    data = out / "share" / "data"
+    for i in range(args.data_files):
+        path = data / f"group{i % 10}" / f"file{i}.dat"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(rng.randbytes(512))
+
+    return {
+        "interpreter": interpreter,
+        "libc_lib": libc_lib,
+        "paths": [out],
+        "libs": [lib_dirs[0]],
+        "elf_files": elf_paths,
+    }
+
+
+def load_auto_patchelf():
+    spec = importlib.util.spec_from_file_location("auto_patchelf", AUTO_PATCHELF)
+    module = importlib.util.module_from_spec(spec)
+    # Registered so that forked workers can unpickle its functions.
+    sys.modules["auto_patchelf"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def install_patchelf_stub(bin_dir: Path, log: Path) -> None:
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    stub = bin_dir / "patchelf"
+    stub.write_text(f'#!/bin/sh\necho "$@" >> {log.as_posix()}\n')
+    stub.chmod(0o755)
+
+
+def summarize(samples: list[float]) -> dict:
+    return {
+        "min": min(samples),
+        "median": statistics.median(samples),
+        "max": max(samples),
+        "samples": samples,
+    }
+
+
+def run_once(workdir: Path, args: argparse.Namespace, module) -> dict:
+    tree = generate_tree(workdir / "tree", args)
+    log = workdir / "patchelf.log"
+    env = dict(os.environ)
+    if not args.real_patchelf:
+        install_patchelf_stub(workdir / "bin", log)
+        env["PATH"] = f"{workdir / 'bin'}:{env.get('PATH', '')}"
+
+    # In-process phases, with the output of auto-patchelf discarded.
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        path_env, os.environ["PATH"] = os.environ.get("PATH", ""), env["PATH"]
+        try:
+            patcher = module.AutoPatchelf(tree["interpreter"], tree["libc_lib"])
+            start = time.perf_counter()
+            patcher.populate_cache(tree["paths"], True)
+            patcher.populate_cache(tree["libs"])
+            populate_cache = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for path in tree["elf_files"]:
+                patcher.auto_patchelf_file(path, [], keep_libc=False)
+            patch_files = time.perf_counter() - start
+        finally:
+            sys.stdout = stdout
+            os.environ["PATH"] = path_env
+
+    # The in-process pass may have patched the files for real.
+    if args.real_patchelf:
+        shutil.rmtree(workdir / "tree")
+        tree = generate_tree(workdir / "tree", args)
+    log.unlink(missing_ok=True)
+
+    # End-to-end run in a fresh interpreter, as the setup hook does it.
+    env["NIX_BINTOOLS"] = (workdir / "bintools").as_posix()
+    nix_support = workdir / "bintools" / "nix-support"
+    nix_support.mkdir(parents=True, exist_ok=True)
+    (nix_support / "dynamic-linker").write_text(tree["interpreter"].as_posix())
+    (nix_support / "orig-libc").write_text(tree["libc_lib"].parent.as_posix())
+
+    command = [sys.executable, AUTO_PATCHELF.as_posix(),
+               "--paths", *map(str, tree["paths"]),
+               "--libs", *map(str, tree["libs"]),
+               "--ignore-missing", "*",
+               "--jobs", str(args.jobs)]
+    if args.batch:
+        command.append("--batch")
+
+    start = time.perf_counter()
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(process.pid, 0)
+    end_to_end = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        sys.exit(f"auto-patchelf failed with exit code {process.returncode}")
+
+    invocations = None
+    if not args.real_patchelf:
+        invocations = len(log.read_text().splitlines()) if log.exists() else 0
+
+    return {
+        "populate_cache": populate_cache,
+        "auto_patchelf_file": patch_files / max(len(tree["elf_files"]), 1),
+        "end_to_end": end_to_end,
+        # ru_maxrss is in KiB on Linux. Forked --jobs workers are not
+        # included, only the main auto-patchelf process.
+        "max_rss_kib": rusage.ru_maxrss,
+        "patchelf_invocations": invocations,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="auto-patchelf-benchmark",
+        description="Benchmark auto-patchelf on synthetic trees of ELF files"
+                    " and print the results as JSON.")
+    parser.add_argument("--files", type=int, default=2000,
+                        help="Number of ELF files in the tree to patch.")
+    parser.add_argument("--libs", type=int, default=200,
+                        help="Number of libraries to resolve dependencies against.")
+    parser.add_argument("--needed", type=int, default=8,
+                        help="Number of DT_NEEDED entries per file, besides libc.")
+    parser.add_argument("--rpath-depth", type=int, default=3,
+                        help="Length of the chain of library directories linked by RUNPATH.")
+    parser.add_argument("--dlopen-ratio", type=float, default=0.1,
+                        help="Share of files with a .note.dlopen note.")
+    parser.add_argument("--symlink-ratio", type=float, default=0.2,
+                        help="Share of files and libraries with an additional symlink.")
+    parser.add_argument("--data-files", type=int, default=2000,
+                        help="Number of non-ELF files in the tree to patch.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the tree generator.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of times each measurement is taken.")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Value of --jobs for the end-to-end run.")
+    parser.add_argument("--batch", action="store_true",
+                        help="Pass --batch to the end-to-end run.")
+    parser.add_argument("--real-patchelf", action="store_true",
+                        help="Run the patchelf from PATH instead of a stub.")
+    parser.add_argument("--output", type=Path, default=None,
+                        help="Write the results to this file instead of stdout.")
+    args = parser.parse_args()
+
+    module = load_auto_patchelf()
+
+    runs = []
+    for _ in range(args.repeat):
+        with tempfile.TemporaryDirectory(prefix="auto-patchelf-benchmark-") as workdir:
+            runs.append(run_once(Path(workdir), args, module))
+
+    results = {
+        "version": 1,
+        "parameters": {k: str(v) if isinstance(v, Path) else v for k, v in vars(args).items()},
+        "environment": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+        },
+        "results": {
+            name: summarize([run[name] for run in runs])
+            for name in ("populate_cache", "auto_patchelf_file", "end_to_end", "max_rss_kib")
+        },
+        "patchelf_invocations": runs[0]["patchelf_invocations"],
+    }
+
+    output = json.dumps(results, indent=2) + "\n"
+    if args.output:
+        args.output.write_text(output)
+    else:
+        sys.stdout.write(output)
+
+
+if __name__ == "__main__":
+    main()
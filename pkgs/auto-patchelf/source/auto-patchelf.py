@@ -1,16 +1,24 @@
 #!/usr/bin/env python3
 
 import argparse
+import hashlib
+import io
+import mmap
 import os
 import pprint
+import struct
 import subprocess
 import sys
+import time
 import json
-from fnmatch import fnmatch
-from collections import defaultdict
-from contextlib import contextmanager
-from dataclasses import dataclass
+from fnmatch import fnmatch, fnmatchcase
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+from dataclasses import dataclass, field
+from functools import cache, partial
 from itertools import chain
+from multiprocessing import get_context
 from pathlib import Path, PurePath
 from typing import DefaultDict, Generator, Iterator, Optional
 
@@ -18,7 +26,7 @@ from elftools.common.exceptions import ELFError  # type: ignore
 from elftools.elf.dynamic import DynamicSection  # type: ignore
 from elftools.elf.sections import NoteSection  # type: ignore
 from elftools.elf.elffile import ELFFile  # type: ignore
-from elftools.elf.enums import ENUM_E_TYPE, ENUM_EI_OSABI  # type: ignore
+from elftools.elf.enums import ENUM_E_MACHINE, ENUM_E_TYPE, ENUM_EI_OSABI  # type: ignore
 
 
 DEFAULT_BINTOOLS = "@defaultBintools@"
@@ -102,6 +110,26 @@ def get_rpath(elf: ELFFile) -> list[str]:
     return []
 
 
+def get_rpath_tags(elf: ELFFile) -> tuple[Optional[str], Optional[str]]:
+    """
+    Returns the raw values of DT_RUNPATH and DT_RPATH, if present.
+    """
+    runpath = rpath = None
+    for section in elf.iter_sections():
+        if isinstance(section, DynamicSection):
+            for tag in section.iter_tags('DT_RUNPATH'):
+                runpath = tag.runpath
+                break
+
+            for tag in section.iter_tags('DT_RPATH'):
+                rpath = tag.rpath
+                break
+
+            break # There is only one dynamic section
+
+    return runpath, rpath
+
+
 def get_arch(elf: ELFFile) -> str:
     return elf.get_machine_arch()
 
@@ -110,6 +138,241 @@ def get_osabi(elf: ELFFile) -> str:
     return elf.header["e_ident"]["EI_OSABI"]
 
 
+@dataclass
+class ElfInfo:
+    """
+    The properties of an ELF file that auto-patchelf needs, gathered at once.
+    """
+    e_type: str
+    arch: str
+    osabi: str
+    num_segments: int
+    has_interp_section: bool
+    interpreter: Optional[str]          # Contents of PT_INTERP, if any
+    needed: list[str]                   # DT_NEEDED entries
+    dlopen: list[list[str]]             # Candidate sonames from .note.dlopen
+    dt_runpath: Optional[str]
+    dt_rpath: Optional[str]
+    is_separate_debug_object: bool
+
+    @classmethod
+    def from_elffile(cls, elf: ELFFile) -> "ElfInfo":
+        interpreter = None
+        for segment in elf.iter_segments('PT_INTERP'):
+            interpreter = segment.get_interp_name()
+            break
+        dt_runpath, dt_rpath = get_rpath_tags(elf)
+        return cls(
+            e_type=elf.header["e_type"],
+            arch=get_arch(elf),
+            osabi=get_osabi(elf),
+            num_segments=elf.num_segments(),
+            has_interp_section=is_dynamic_executable(elf),
+            interpreter=interpreter,
+            needed=[str(dep) for [dep] in get_dependencies(elf)],
+            dlopen=[[str(soname) for soname in dep] for dep in get_dlopen_dependencies(elf)],
+            dt_runpath=dt_runpath,
+            dt_rpath=dt_rpath,
+            is_separate_debug_object=is_separate_debug_object(elf))
+
+    @property
+    def is_static_executable(self) -> bool:
+        # Statically linked executables have an ELF type of EXEC but no INTERP.
+        return self.e_type == 'ET_EXEC' and not self.has_interp_section
+
+    @property
+    def is_dynamic_executable(self) -> bool:
+        # See is_dynamic_executable() for why the ELF type is not checked.
+        return self.has_interp_section
+
+    @property
+    def rpath(self) -> list[str]:
+        # DT_RUNPATH takes precedence over DT_RPATH, like in the dynamic linker.
+        if self.dt_runpath is not None:
+            return self.dt_runpath.split(':')
+        if self.dt_rpath is not None:
+            return self.dt_rpath.split(':')
+        return []
+
+    @property
+    def dependencies(self) -> list[list[Path]]:
+        return ([[Path(dep)] for dep in self.needed]
+                + [[Path(soname) for soname in dep] for dep in self.dlopen])
+
+
+ELF_MAGIC = b"\x7fELF"
+
+# Layouts of the ELF header (after e_ident), program header, section header
+# and dynamic entry, indexed by EI_CLASS.
+ELF_STRUCTS = {
+    1: ("HHIIIIIHHHHHH", "IIIIIIII", "IIIIIIIIII", "iI"),
+    2: ("HHIQQQIHHHHHH", "IIQQQQQQ", "IIQQQQIIQQ", "qQ"),
+}
+
+PT_INTERP = 3
+SHT_DYNAMIC = 6
+SHT_NOTE = 7
+SHT_NOBITS = 8
+DT_NULL = 0
+DT_NEEDED = 1
+DT_RPATH = 15
+DT_RUNPATH = 29
+NT_FDO_DLOPEN = 0x407C0C0A
+
+
+# pyelftools names for the enumerated header fields. Like pyelftools, values
+# without a name are left as plain integers.
+E_TYPE_NAMES = {v: k for k, v in ENUM_E_TYPE.items() if isinstance(v, int)}
+E_MACHINE_NAMES = {v: k for k, v in ENUM_E_MACHINE.items() if isinstance(v, int)}
+EI_OSABI_NAMES = {v: k for k, v in ENUM_EI_OSABI.items() if isinstance(v, int)}
+
+
+@cache
+def machine_arch(e_machine: int) -> str:
+    # Reuse the naming of pyelftools, as architectures are compared against
+    # the ones it reports for the interpreter.
+    return ELFFile.get_machine_arch({"e_machine": E_MACHINE_NAMES.get(e_machine, e_machine)})
+
+
+def cstring(data: "mmap.mmap", offset: int) -> bytes:
+    end = data.find(b"\0", offset)
+    if end < 0:
+        raise ValueError("unterminated string")
+    return data[offset:end]
+
+
+def parse_elf_info(data: "mmap.mmap") -> ElfInfo:
+    """
+    Parses the ELF header, program headers, section headers, the dynamic
+    section and .note.dlopen notes directly from the mapped file, without
+    building any pyelftools objects. Raises on anything unexpected, in which
+    case the caller falls back to pyelftools.
+    """
+    ei_class, ei_data, ei_osabi = data[4], data[5], data[7]
+    order = {1: "<", 2: ">"}[ei_data]
+    ehdr_fmt, phdr_fmt, shdr_fmt, dyn_fmt = (order + f for f in ELF_STRUCTS[ei_class])
+
+    (e_type, e_machine, _, _, e_phoff, e_shoff, _, _, e_phentsize, e_phnum,
+     e_shentsize, e_shnum, e_shstrndx) = struct.unpack_from(ehdr_fmt, data, 16)
+
+    # Section headers, as (name, type, offset, size, link, info)
+    sections = []
+    if e_shoff:
+        if e_shentsize != struct.calcsize(shdr_fmt):
+            raise ValueError("unexpected section header size")
+        first = struct.unpack_from(shdr_fmt, data, e_shoff)
+        # Extended numbering, see elf(5)
+        if e_shnum == 0:
+            e_shnum = first[5]
+        if e_shstrndx == 0xffff:
+            e_shstrndx = first[6]
+        for header in struct.iter_unpack(shdr_fmt, data[e_shoff:e_shoff + e_shnum * e_shentsize]):
+            sh_name, sh_type, _, _, sh_offset, sh_size, sh_link, sh_info, _, _ = header
+            sections.append((sh_name, sh_type, sh_offset, sh_size, sh_link, sh_info))
+        if len(sections) != e_shnum:
+            raise ValueError("truncated section header table")
+
+    names = {}
+    named_sections = []
+    if sections:
+        shstrtab_offset = sections[e_shstrndx][2]
+        for index, section in enumerate(sections):
+            name = cstring(data, shstrtab_offset + section[0]).decode('utf-8', errors='replace')
+            # Like pyelftools, the last section with a given name wins.
+            names[name] = index
+            named_sections.append((name, section))
+
+    num_segments = e_phnum if e_phnum < 0xffff else sections[0][5]
+    interpreter = None
+    if e_phoff:
+        if e_phentsize != struct.calcsize(phdr_fmt):
+            raise ValueError("unexpected program header size")
+        for n in range(num_segments):
+            header = struct.unpack_from(phdr_fmt, data, e_phoff + n * e_phentsize)
+            if header[0] != PT_INTERP:
+                continue
+            p_offset = header[2] if ei_class == 2 else header[1]
+            interpreter = cstring(data, p_offset).decode('latin-1')
+            break
+
+    needed = []
+    dt_rpath = None
+    dt_runpath = None
+    for _, (_, sh_type, sh_offset, sh_size, sh_link, _) in named_sections:
+        if sh_type != SHT_DYNAMIC:
+            continue
+        strtab_offset = sections[sh_link][2]
+        entsize = struct.calcsize(dyn_fmt)
+        entries = data[sh_offset:sh_offset + sh_size - sh_size % entsize]
+        for d_tag, d_val in struct.iter_unpack(dyn_fmt, entries):
+            if d_tag == DT_NULL:
+                break
+            elif d_tag in (DT_NEEDED, DT_RUNPATH, DT_RPATH):
+                value = cstring(data, strtab_offset + d_val).decode('utf-8', errors='replace')
+                if d_tag == DT_NEEDED:
+                    needed.append(value)
+                elif d_tag == DT_RUNPATH and dt_runpath is None:
+                    dt_runpath = value
+                elif d_tag == DT_RPATH and dt_rpath is None:
+                    dt_rpath = value
+        break # There is only one dynamic section
+
+    dlopen = []
+    for name, (_, sh_type, sh_offset, sh_size, _, _) in named_sections:
+        if sh_type != SHT_NOTE or name != ".note.dlopen":
+            continue
+        offset, end = sh_offset, sh_offset + sh_size
+        while offset + 12 < end:
+            n_namesz, n_descsz, n_type = struct.unpack_from(order + "III", data, offset)
+            offset += 12
+            n_name = data[offset:offset + n_namesz].split(b"\0", 1)[0].decode('latin-1')
+            offset += (n_namesz + 3) & ~3
+            n_desc = data[offset:offset + n_descsz]
+            offset += (n_descsz + 3) & ~3
+            if n_type != NT_FDO_DLOPEN or n_name != "FDO":
+                continue
+            for d in json.loads(n_desc.decode("utf-8").rstrip("\0")):
+                dlopen.append(list(d["soname"]))
+
+    text = names.get(".text")
+    has_dwarf_info = any(name in names for name in (".debug_info", ".zdebug_info", ".eh_frame"))
+
+    return ElfInfo(
+        e_type=E_TYPE_NAMES.get(e_type, e_type),
+        arch=machine_arch(e_machine),
+        osabi=EI_OSABI_NAMES.get(ei_osabi, ei_osabi),
+        num_segments=num_segments,
+        has_interp_section=".interp" in names,
+        interpreter=interpreter,
+        needed=needed,
+        dlopen=dlopen,
+        dt_runpath=dt_runpath,
+        dt_rpath=dt_rpath,
+        is_separate_debug_object=(has_dwarf_info and text is not None
+                                  and sections[text][1] == SHT_NOBITS))
+
+
+def read_elf_info(path: Path) -> ElfInfo:
+    """
+    Reads an ElfInfo from a memory map of the file, falling back to
+    pyelftools for files the minimal parser above does not understand.
+    Raises ELFError for files that are not ELF files at all.
+    """
+    with path.open('rb', buffering=0) as stream:
+        # Most files in a package are not ELF files. Telling them apart by
+        # their first bytes costs a single read(2), without mapping them.
+        if stream.read(len(ELF_MAGIC)) != ELF_MAGIC:
+            raise ELFError(f"{path} is not an ELF file")
+        with mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            try:
+                return parse_elf_info(data)
+            except (struct.error, ValueError, KeyError, IndexError):
+                pass
+
+    with open_elf(path) as elf:
+        return ElfInfo.from_elffile(elf)
+
+
 def osabi_are_compatible(wanted: str, got: str) -> bool:
     """
     Tests whether two OS ABIs are compatible, taking into account the
@@ -141,67 +404,251 @@ def osabi_are_compatible(wanted: str, got: str) -> bool:
     return wanted == got
 
 
-def glob(path: Path, pattern: str, recursive: bool) -> Iterator[Path]:
-    if path.is_dir():
-        return path.rglob(pattern) if recursive else path.glob(pattern)
-    else:
-        # path.glob won't return anything if the path is not a directory.
-        # We extend that behavior by matching the file name against the pattern.
-        # This allows to pass single files instead of dirs to auto_patchelf,
-        # for greater control on the files to consider.
-        return [path] if path.match(pattern) else []
-
+def iter_files(path: Path, pattern: str, recursive: bool, follow_symlinks: bool = True) -> Iterator[Path]:
+    """
+    Yields the files in path whose name matches pattern, in the same order
+    as Path.glob or Path.rglob would. Symlinks to files are only included
+    if follow_symlinks is set.
+    """
+    for file, _ in scan_files(path, pattern, recursive, follow_symlinks):
+        yield file
 
-cached_paths: set[Path] = set()
-soname_cache: DefaultDict[tuple[str, str], list[tuple[Path, str]]] = defaultdict(list)
 
+def scan_files(path: Path, pattern: str, recursive: bool, follow_symlinks: bool = True) -> Iterator[tuple[Path, bool]]:
+    """
+    Like iter_files, but also yields whether each file is a symlink. Each
+    directory is read once with os.scandir, whose entries usually know
+    their type from readdir(3) alone, so most files are never stat'ed.
+    """
+    if not path.is_dir():
+        # We extend the glob behavior by matching the file name against the
+        # pattern. This allows to pass single files instead of dirs to
+        # auto_patchelf, for greater control on the files to consider.
+        if path.match(pattern) and path.is_file():
+            is_symlink = path.is_symlink()
+            if follow_symlinks or not is_symlink:
+                yield path, is_symlink
+        return
+
+    directories = [path]
+    while directories:
+        directory = directories.pop()
+        subdirectories = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if recursive:
+                                subdirectories.append(directory / entry.name)
+                        elif fnmatchcase(entry.name, pattern) and entry.is_file():
+                            is_symlink = entry.is_symlink()
+                            if follow_symlinks or not is_symlink:
+                                yield directory / entry.name, is_symlink
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+        # Descend depth-first, in directory order, like Path.rglob.
+        directories.extend(reversed(subdirectories))
 
-def populate_cache(initial: list[Path], recursive: bool =False) -> None:
-    lib_dirs = list(initial)
 
-    while lib_dirs:
-        lib_dir = lib_dirs.pop(0)
+@dataclass
+class LibDirScan:
+    """
+    Everything populate_cache learns from a single library directory.
+    """
+    # (soname, arch, directory, osabi) for each library, in discovery order
+    libraries: list[tuple[str, str, Path, str]] = field(default_factory=list)
+    # RPATH entries of these libraries, to be searched next
+    rpath: list[Path] = field(default_factory=list)
+    # Separate debug objects that were skipped
+    debug_objects: list[Path] = field(default_factory=list)
+
+
+def scan_lib_dir(lib_dir: Path, recursive: bool) -> LibDirScan:
+    scan = LibDirScan()
+
+    for path, is_symlink in scan_files(lib_dir, "*.so*", recursive):
+        # As an optimisation, resolve the symlinks here, as the target is unique
+        # XXX: (layus, 2022-07-25) is this really an optimisation in all cases ?
+        # It could make the rpath bigger or break the fragile precedence of $out.
+        resolved = path.resolve() if is_symlink else path
+        # Do not use resolved paths when names do not match
+        if resolved.name != path.name:
+            resolved = path
+
+        try:
+            info = read_elf_info(path)
+        except ELFError:
+            # Not an ELF file in the right format
+            continue
 
-        if lib_dir in cached_paths:
+        if info.is_separate_debug_object:
+            scan.debug_objects.append(path)
             continue
 
-        cached_paths.add(lib_dir)
+        scan.rpath += [Path(p) for p in info.rpath
+                               if p and '$ORIGIN' not in p]
+        scan.libraries.append((path.name, info.arch, resolved.parent, info.osabi))
 
-        for path in glob(lib_dir, "*.so*", recursive):
-            if not path.is_file():
-                continue
+    return scan
 
-            # As an optimisation, resolve the symlinks here, as the target is unique
-            # XXX: (layus, 2022-07-25) is this really an optimisation in all cases ?
-            # It could make the rpath bigger or break the fragile precedence of $out.
-            resolved = path.resolve()
-            # Do not use resolved paths when names do not match
-            if resolved.name != path.name:
-                resolved = path
 
-            try:
-                with open_elf(path) as elf:
-                    if is_separate_debug_object(elf):
-                        print(f"skipping {path} because it looks like a separate debug object")
-                        continue
+def store_path_of(path: Path) -> Optional[Path]:
+    """
+    Returns the top-level store path containing the given path, if any.
+    """
+    store_dir = Path(os.environ.get("NIX_STORE", "/nix/store"))
+    try:
+        relative = Path(os.path.normpath(path)).relative_to(store_dir)
+    except ValueError:
+        return None
+    return store_dir / relative.parts[0] if relative.parts else None
 
-                    osabi = get_osabi(elf)
-                    arch = get_arch(elf)
-                    rpath = [Path(p) for p in get_rpath(elf)
-                                     if p and '$ORIGIN' not in p]
-                    lib_dirs += rpath
-                    soname_cache[(path.name, arch)].append((resolved.parent, osabi))
 
-            except ELFError:
-                # Not an ELF file in the right format
-                pass
+def build_outputs() -> list[Path]:
+    """
+    Returns the outputs of the derivation being built, if any, like
+    getAllOutputNames does in the setup hook.
+    """
+    attrs_file = os.environ.get("NIX_ATTRS_JSON_FILE")
+    if attrs_file:
+        try:
+            with open(attrs_file) as f:
+                outputs = json.load(f).get("outputs", {})
+            return [Path(p) for p in outputs.values()]
+        except (OSError, ValueError, AttributeError):
+            return []
+    names = os.environ.get("outputs", "out").split()
+    return [Path(os.environ[name]) for name in names if os.environ.get(name)]
+
+
+class PersistentSonameCache:
+    """
+    On-disk cache of the libraries found in store paths.
+
+    Store paths are immutable, so scanning a library directory inside one
+    always yields the same result. Entries are keyed by the scanned path,
+    which embeds the hash of its store path. The store paths being patched
+    and every output of the derivation being built are still mutable while
+    the build runs and are never cached, and neither is anything outside
+    the store, such as $NIX_BUILD_TOP.
+    """
+
+    version = 1
+
+    def __init__(self, directory: Path, mutable_paths: list[Path]) -> None:
+        self.directory = directory
+        self.mutable_store_paths = {store_path_of(p) for p in [*mutable_paths, *build_outputs()]} - {None}
+        self.hits = 0
+        self.misses = 0
+
+    def entry_path(self, lib_dir: Path, recursive: bool) -> Optional[Path]:
+        store_path = store_path_of(lib_dir)
+        if store_path is None or store_path in self.mutable_store_paths:
+            return None
+        key = f"{lib_dir.as_posix()}\0{recursive}".encode()
+        digest = hashlib.sha256(key).hexdigest()
+        return self.directory / f"{store_path.name[:32]}-{digest}.json"
+
+    def load(self, entry: Path) -> Optional[LibDirScan]:
+        try:
+            with entry.open() as f:
+                data = json.load(f)
+            if data["version"] != self.version:
+                return None
+            return LibDirScan(
+                libraries=[(name, arch, Path(directory), osabi)
+                           for name, arch, directory, osabi in data["libraries"]],
+                rpath=[Path(p) for p in data["rpath"]],
+                debug_objects=[Path(p) for p in data["debug_objects"]])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def store(self, entry: Path, scan: LibDirScan) -> None:
+        data = {
+            "version": self.version,
+            "libraries": [(name, arch, directory.as_posix(), osabi)
+                          for name, arch, directory, osabi in scan.libraries],
+            "rpath": [p.as_posix() for p in scan.rpath],
+            "debug_objects": [p.as_posix() for p in scan.debug_objects],
+        }
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            # Several builds may scan the same dependency at once, each
+            # renaming its own copy over the entry.
+            tmp = entry.with_name(f"{entry.name}.{os.getpid()}.tmp")
+            tmp.write_text(json.dumps(data))
+            tmp.replace(entry)
+        except OSError as e:
+            print(f"warn: auto-patchelf could not write cache entry {entry}: {e}")
+
+    def scan(self, lib_dir: Path, recursive: bool) -> LibDirScan:
+        entry = self.entry_path(lib_dir, recursive)
+        if entry is None:
+            return scan_lib_dir(lib_dir, recursive)
+
+        scan = self.load(entry)
+        if scan is not None:
+            self.hits += 1
+            return scan
+
+        self.misses += 1
+        scan = scan_lib_dir(lib_dir, recursive)
+        self.store(entry, scan)
+        return scan
+
+
+def default_cache_dir() -> Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "auto-patchelf"
+
+
+@cache
+def list_libc_files(libc_lib: Path) -> frozenset[str]:
+    try:
+        with os.scandir(libc_lib) as entries:
+            return frozenset(entry.name for entry in entries if entry.is_file())
+    except OSError:
+        return frozenset()
+
 
+class PatchelfBatch:
+    """
+    Collects the patchelf edits of many files, so that all files needing the
+    same edits are patched by a single patchelf process.
+    """
 
-def find_dependency(soname: str, soarch: str, soabi: str) -> Optional[Path]:
-    for lib, libabi in soname_cache[(soname, soarch)]:
-        if osabi_are_compatible(soabi, libabi):
-            return lib
-    return None
+    # Bound the number of files per invocation to stay clear of ARG_MAX.
+    max_files = 256
+
+    def __init__(self) -> None:
+        self.files: dict[tuple[str, ...], list[Path]] = {}
+
+    def add(self, flags: list[str], path: Path) -> None:
+        self.files.setdefault(tuple(flags), []).append(path)
+
+    def merge(self, other: "PatchelfBatch") -> None:
+        for flags, paths in other.files.items():
+            self.files.setdefault(flags, []).extend(paths)
+
+    def run(self, extra_args: list[str] = [], jobs: int = 1) -> float:
+        """
+        Runs all collected edits and returns the time spent doing so.
+        """
+        commands = [
+            ["patchelf", *flags, *(p.as_posix() for p in paths[i:i + self.max_files])] + extra_args
+            for flags, paths in self.files.items()
+            for i in range(0, len(paths), self.max_files)
+        ]
+        num_files = sum(len(paths) for paths in self.files.values())
+        print(f"patching {num_files} files with {len(commands)} patchelf invocations")
+        sys.stdout.flush()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            list(executor.map(partial(subprocess.run, check=True), commands))
+        return time.perf_counter() - start
 
 
 @dataclass
@@ -211,169 +658,482 @@ class Dependency:
     found: bool = False     # Whether it was found somewhere
 
 
-def auto_patchelf_file(path: Path, runtime_deps: list[Path], append_rpaths: list[Path] = [], keep_libc: bool = False, extra_args: list[str] = []) -> list[Dependency]:
-    try:
-        with open_elf(path) as elf:
+@dataclass
+class PatchResult:
+    path: Path
+    dependencies: list[Dependency] = field(default_factory=list)
+    up_to_date: bool = False                # Whether the file already had the wanted edits
+    is_elf: bool = True
+    skipped: Optional[str] = None           # Why the file was not considered for patching
+    interpreter: Optional[str] = None       # The interpreter set on the file
+    rpath: Optional[str] = None             # The RPATH set on the file
+    # How each dependency was resolved, as (name, resolution, directory)
+    resolutions: list[tuple[str, str, Optional[Path]]] = field(default_factory=list)
+    # Time spent in each phase, in seconds
+    timings: dict[str, float] = field(default_factory=dict)
+
+    def skip(self, reason: str) -> "PatchResult":
+        print(f"skipping {self.path} because {reason}")
+        self.skipped = reason
+        return self
+
+
+class AutoPatchelfError(Exception):
+    """
+    Raised by AutoPatchelf.auto_patchelf when it cannot patch the given paths.
+    """
 
-            if is_static_executable(elf):
-                # No point patching these
-                print(f"skipping {path} because it is statically linked")
-                return []
 
-            if elf.num_segments() == 0:
-                # no segment (e.g. object file)
-                print(f"skipping {path} because it contains no segment")
-                return []
+def is_up_to_date(info: ElfInfo, interpreter: Optional[str], rpath: Optional[str], extra_args: list[str]) -> bool:
+    """
+    Tests whether setting the given interpreter and RPATH (None for no change)
+    would leave the file as it is, e.g. because it was already patched by a
+    previous run.
+    """
+    # Other patchelf flags are edits of their own we cannot check for.
+    if any(arg != "--force-rpath" for arg in extra_args):
+        return False
 
-            file_arch = get_arch(elf)
-            if interpreter_arch != file_arch:
-                # Our target architecture is different than this file's
-                # architecture, so skip it.
-                print(f"skipping {path} because its architecture ({file_arch})"
-                      f" differs from target ({interpreter_arch})")
-                return []
+    if interpreter is not None and info.interpreter != interpreter:
+        return False
 
-            file_osabi = get_osabi(elf)
-            if not osabi_are_compatible(interpreter_osabi, file_osabi):
-                print(f"skipping {path} because its OS ABI ({file_osabi}) is"
-                      f" not compatible with target ({interpreter_osabi})")
-                return []
+    if rpath is not None:
+        # patchelf turns DT_RPATH into DT_RUNPATH unless --force-rpath is
+        # given, so the entry must also be of the expected kind.
+        if "--force-rpath" in extra_args:
+            return info.dt_rpath == rpath and info.dt_runpath is None
+        return info.dt_runpath == rpath and info.dt_rpath is None
 
-            file_is_dynamic_executable = is_dynamic_executable(elf)
+    return True
 
-            file_dependencies = get_dependencies(elf) + get_dlopen_dependencies(elf)
 
-    except ELFError:
-        return []
+class AutoPatchelf:
+    """
+    Patches ELF files against the libraries it knows about.
 
-    # these platforms are packaged in nixpkgs with ld.so in a separate derivation
-    # than libc.so and friends. keep_libc is mandatory.
-    keep_libc |= file_osabi in ('ELFOSABI_FREEBSD', 'ELFOSABI_OPENBSD')
+    An instance holds the properties of the target dynamic linker and every
+    library directory scanned by populate_cache, so that a build driver can
+    patch several outputs in turn while reusing what it has already learned.
+    Each call of auto_patchelf still looks up libraries in its own order,
+    starting with the paths it patches.
+    """
 
-    rpath = []
-    if file_is_dynamic_executable:
-        print("setting interpreter of", path)
-        subprocess.run(
-                ["patchelf", "--set-interpreter", interpreter_path.as_posix(), path.as_posix()] + extra_args,
-                check=True)
-        rpath += runtime_deps
+    def __init__(self, interpreter_path: Path, libc_lib: Path) -> None:
+        self.interpreter_path = interpreter_path
+        self.libc_lib = libc_lib
+
+        interpreter = read_elf_info(interpreter_path)
+        self.interpreter_osabi: str = interpreter.osabi
+        self.interpreter_arch: str = interpreter.arch
+
+        # Scans of the library directories seen so far, by (directory, recursive)
+        self.lib_dir_scans: dict[tuple[Path, bool], LibDirScan] = {}
+        # The directories added to soname_cache since the last reset_cache, in order
+        self.cached_paths: set[Path] = set()
+        self.soname_cache: DefaultDict[tuple[str, str], list[tuple[Path, str]]] = defaultdict(list)
+        # Memoized results of find_dependency, only valid for the current soname_cache
+        self.resolved_dependencies: dict[tuple[str, str, str], Optional[Path]] = {}
+
+    @classmethod
+    def from_bintools(cls, bintools: Path) -> "AutoPatchelf":
+        """
+        Targets the dynamic linker and libc of the given bintools wrapper.
+        """
+        nix_support = bintools / 'nix-support'
+        interpreter_path = Path((nix_support / 'dynamic-linker').read_text().strip())
+        libc_lib = Path((nix_support / 'orig-libc').read_text().strip()) / 'lib'
+        return cls(interpreter_path, libc_lib)
+
+    def reset_cache(self, mutable_paths: list[Path] = []) -> None:
+        """
+        Empties the soname cache, so that libraries are found in the order in
+        which it is populated again. The scans of the library directories are
+        kept, except for those inside mutable_paths, which may have changed.
+        """
+        self.cached_paths.clear()
+        self.soname_cache.clear()
+        self.resolved_dependencies.clear()
+        self.lib_dir_scans = {
+            (lib_dir, recursive): scan
+            for (lib_dir, recursive), scan in self.lib_dir_scans.items()
+            if not any(lib_dir.is_relative_to(p) for p in mutable_paths)
+        }
+
+    def populate_cache(self, initial: list[Path], recursive: bool =False, persistent_cache: Optional[PersistentSonameCache] = None) -> None:
+        lib_dirs = deque(initial)
+
+        # New libraries may take precedence over previously resolved ones.
+        self.resolved_dependencies.clear()
+
+        while lib_dirs:
+            lib_dir = lib_dirs.popleft()
+
+            if lib_dir in self.cached_paths:
+                continue
 
-    print("searching for dependencies of", path)
-    dependencies = []
-    # Be sure to get the output of all missing dependencies instead of
-    # failing at the first one, because it's more useful when working
-    # on a new package where you don't yet know the dependencies.
-    for dep in file_dependencies:
-        was_found = False
-        for candidate in dep:
-
-            # This loop determines which candidate for a given
-            # dependency can be found, and how. There may be multiple
-            # candidates for a dep because of '.note.dlopen'
-            # dependencies.
-            #
-            # 1. If a candidate is an absolute path, it is already a
-            #    valid dependency if that path exists, and nothing needs
-            #    to be done. It should be an error if that path does not exist.
-            # 2. If a candidate is found within libc, it should be dropped
-            #    and resolved automatically by the dynamic linker, unless
-            #    keep_libc is enabled.
-            # 3. If a candidate is found in our library dependencies, that
-            #    dependency should be added to rpath.
-            # 4. If all of the above fail, libc dependencies should still be
-            #    considered found. This is in contrast to step 2, because
-            #    enabling keep_libc should allow libc to be found in step 3
-            #    if possible to preserve its presence in rpath.
-            #
-            # These conditions are checked in this order, because #2
-            # and #3 may both be true. In that case, we still want to
-            # add the dependency to rpath, as the original binary
-            # presumably had it and this should be preserved.
-
-            is_libc = (libc_lib / candidate).is_file()
-
-            if candidate.is_absolute() and candidate.is_file():
-                was_found = True
-                break
-            elif is_libc and not keep_libc:
-                was_found = True
-                break
-            elif found_dependency := find_dependency(candidate.name, file_arch, file_osabi):
-                rpath.append(found_dependency)
-                dependencies.append(Dependency(path, candidate, found=True))
-                print(f"    {candidate} -> found: {found_dependency}")
-                was_found = True
-                break
-            elif is_libc and keep_libc:
-                was_found = True
+            self.cached_paths.add(lib_dir)
+
+            scan = self.lib_dir_scans.get((lib_dir, recursive))
+            if scan is None:
+                if persistent_cache:
+                    scan = persistent_cache.scan(lib_dir, recursive)
+                else:
+                    scan = scan_lib_dir(lib_dir, recursive)
+                self.lib_dir_scans[(lib_dir, recursive)] = scan
+
+            for path in scan.debug_objects:
+                print(f"skipping {path} because it looks like a separate debug object")
+
+            for name, arch, directory, osabi in scan.libraries:
+                self.soname_cache[(name, arch)].append((directory, osabi))
+
+            lib_dirs.extend(p for p in scan.rpath if p not in self.cached_paths)
+
+    def find_dependency(self, soname: str, soarch: str, soabi: str) -> Optional[Path]:
+        # Most files of a package share their dependencies, so every lookup is
+        # memoized instead of scanning the candidates again for each file.
+        key = (soname, soarch, soabi)
+        if key in self.resolved_dependencies:
+            return self.resolved_dependencies[key]
+
+        found = None
+        for lib, libabi in self.soname_cache.get((soname, soarch), []):
+            if osabi_are_compatible(soabi, libabi):
+                found = lib
                 break
 
-        if not was_found:
-            dep_name = dep[0] if len(dep) == 1 else f"any({', '.join(map(str, dep))})"
-            dependencies.append(Dependency(path, dep_name, found=False))
-            print(f"    {dep_name} -> not found!")
+        self.resolved_dependencies[key] = found
+        return found
+
+    def is_libc_file(self, candidate: Path) -> bool:
+        # Plain sonames are looked up in a listing of self.libc_lib taken once,
+        # rather than with a stat(2) for every dependency of every file.
+        if candidate.is_absolute() or len(candidate.parts) != 1:
+            return (self.libc_lib / candidate).is_file()
+        return candidate.name in list_libc_files(self.libc_lib)
+
+    def auto_patchelf_file(self, path: Path, runtime_deps: list[Path], append_rpaths: list[Path] = [], keep_libc: bool = False, extra_args: list[str] = [], batch: Optional[PatchelfBatch] = None) -> PatchResult:
+        result = PatchResult(path)
+
+        start = time.perf_counter()
+        try:
+            info = read_elf_info(path)
+        except ELFError:
+            result.is_elf = False
+            return result
+        finally:
+            result.timings["elf_parsing"] = time.perf_counter() - start
+
+        if info.is_static_executable:
+            # No point patching these
+            return result.skip("it is statically linked")
+
+        if info.num_segments == 0:
+            # no segment (e.g. object file)
+            return result.skip("it contains no segment")
+
+        file_arch = info.arch
+        if self.interpreter_arch != file_arch:
+            # Our target architecture is different than this file's
+            # architecture, so skip it.
+            return result.skip(f"its architecture ({file_arch})"
+                               f" differs from target ({self.interpreter_arch})")
+
+        file_osabi = info.osabi
+        if not osabi_are_compatible(self.interpreter_osabi, file_osabi):
+            return result.skip(f"its OS ABI ({file_osabi}) is"
+                               f" not compatible with target ({self.interpreter_osabi})")
+
+        file_is_dynamic_executable = info.is_dynamic_executable
+
+        file_dependencies = info.dependencies
+
+        # these platforms are packaged in nixpkgs with ld.so in a separate derivation
+        # than libc.so and friends. keep_libc is mandatory.
+        keep_libc |= file_osabi in ('ELFOSABI_FREEBSD', 'ELFOSABI_OPENBSD')
+
+        patchelf_flags = []
+        rpath = []
+        if file_is_dynamic_executable:
+            print("setting interpreter of", path)
+            patchelf_flags += ["--set-interpreter", self.interpreter_path.as_posix()]
+            rpath += runtime_deps
+
+        start = time.perf_counter()
+        print("searching for dependencies of", path)
+        dependencies = []
+        # Be sure to get the output of all missing dependencies instead of
+        # failing at the first one, because it's more useful when working
+        # on a new package where you don't yet know the dependencies.
+        for dep in file_dependencies:
+            was_found = False
+            for candidate in dep:
+
+                # This loop determines which candidate for a given
+                # dependency can be found, and how. There may be multiple
+                # candidates for a dep because of '.note.dlopen'
+                # dependencies.
+                #
+                # 1. If a candidate is an absolute path, it is already a
+                #    valid dependency if that path exists, and nothing needs
+                #    to be done. It should be an error if that path does not exist.
+                # 2. If a candidate is found within libc, it should be dropped
+                #    and resolved automatically by the dynamic linker, unless
+                #    keep_libc is enabled.
+                # 3. If a candidate is found in our library dependencies, that
+                #    dependency should be added to rpath.
+                # 4. If all of the above fail, libc dependencies should still be
+                #    considered found. This is in contrast to step 2, because
+                #    enabling keep_libc should allow libc to be found in step 3
+                #    if possible to preserve its presence in rpath.
+                #
+                # These conditions are checked in this order, because #2
+                # and #3 may both be true. In that case, we still want to
+                # add the dependency to rpath, as the original binary
+                # presumably had it and this should be preserved.
+
+                is_libc = self.is_libc_file(candidate)
+
+                if candidate.is_absolute() and candidate.is_file():
+                    result.resolutions.append((str(candidate), "absolute", None))
+                    was_found = True
+                    break
+                elif is_libc and not keep_libc:
+                    result.resolutions.append((str(candidate), "libc", None))
+                    was_found = True
+                    break
+                elif found_dependency := self.find_dependency(candidate.name, file_arch, file_osabi):
+                    rpath.append(found_dependency)
+                    dependencies.append(Dependency(path, candidate, found=True))
+                    result.resolutions.append((str(candidate), "rpath", found_dependency))
+                    print(f"    {candidate} -> found: {found_dependency}")
+                    was_found = True
+                    break
+                elif is_libc and keep_libc:
+                    result.resolutions.append((str(candidate), "libc", None))
+                    was_found = True
+                    break
+
+            if not was_found:
+                dep_name = dep[0] if len(dep) == 1 else f"any({', '.join(map(str, dep))})"
+                dependencies.append(Dependency(path, dep_name, found=False))
+                result.resolutions.append((str(dep_name), "missing", None))
+                print(f"    {dep_name} -> not found!")
+
+        rpath.extend(append_rpaths)
+
+        # Dedup the rpath
+        rpath_str = ":".join(dict.fromkeys(map(Path.as_posix, rpath)))
+
+        if rpath:
+            print("setting RPATH to:", rpath_str)
+            patchelf_flags += ["--set-rpath", rpath_str]
+            result.rpath = rpath_str
+
+        if file_is_dynamic_executable:
+            result.interpreter = self.interpreter_path.as_posix()
+
+        result.dependencies = dependencies
+        result.timings["resolution"] = time.perf_counter() - start
+
+        if patchelf_flags and is_up_to_date(info, result.interpreter, result.rpath, extra_args):
+            print(f"not rewriting {path} because it is already up to date")
+            result.up_to_date = True
+            return result
+
+        if patchelf_flags:
+            if batch is not None:
+                batch.add(patchelf_flags, path)
+            else:
+                # A single invocation for all edits, so that the file is only
+                # rewritten once.
+                start = time.perf_counter()
+                subprocess.run(
+                        ["patchelf", *patchelf_flags, path.as_posix()] + extra_args,
+                        check=True)
+                result.timings["patchelf"] = time.perf_counter() - start
+
+        return result
+
+    def auto_patchelf(
+            self,
+            paths_to_patch: list[Path],
+            lib_dirs: list[Path],
+            runtime_deps: list[Path],
+            recursive: bool = True,
+            ignore_missing: list[str] = [],
+            append_rpaths: list[Path] = [],
+            keep_libc: bool = False,
+            add_existing: bool = True,
+            extra_args: list[str] = [],
+            jobs: int = 1,
+            cache_dir: Optional[Path] = None,
+            batch: bool = False,
+            report_file: Optional[Path] = None) -> list[PatchResult]:
+
+        if not paths_to_patch:
+            raise AutoPatchelfError("No paths to patch, stopping.")
+
+        start = time.perf_counter()
+
+        # Libraries found by previous calls must not take precedence over
+        # those of the paths to patch now.
+        self.reset_cache(paths_to_patch)
+
+        persistent_cache = None
+        if cache_dir:
+            persistent_cache = PersistentSonameCache(cache_dir, paths_to_patch)
+
+        # Add all shared objects of the current output path to the cache,
+        # before lib_dirs, so that they are chosen first in find_dependency.
+        if add_existing:
+            self.populate_cache(paths_to_patch, recursive, persistent_cache)
+
+        self.populate_cache(lib_dirs, persistent_cache=persistent_cache)
+
+        timings = {"cache_population": time.perf_counter() - start}
+
+        files = chain.from_iterable(iter_files(p, '*', recursive, follow_symlinks=False)
+                                    for p in paths_to_patch)
+
+        patchelf_batch = PatchelfBatch() if batch else None
+        results = []
+        if jobs > 1:
+            # Workers are forked after the cache has been populated, so they
+            # inherit it along with the interpreter properties. Results come back
+            # in submission order, which keeps the log and the summary identical
+            # to a serial run. Anything still buffered must be flushed first, or
+            # every worker would print it again when it exits.
+            global worker_patcher
+            worker_patcher = self
+            sys.stdout.flush()
+            patch_file = partial(auto_patchelf_file_logged, runtime_deps=runtime_deps,
+                                 append_rpaths=append_rpaths, keep_libc=keep_libc,
+                                 extra_args=extra_args, batch=batch)
+            with ProcessPoolExecutor(max_workers=jobs, mp_context=get_context("fork")) as executor:
+                for log, result, file_batch in executor.map(patch_file, files, chunksize=16):
+                    sys.stdout.write(log)
+                    results.append(result)
+                    if patchelf_batch and file_batch:
+                        patchelf_batch.merge(file_batch)
+        else:
+            for path in files:
+                results.append(self.auto_patchelf_file(path, runtime_deps, append_rpaths, keep_libc, extra_args, patchelf_batch))
+
+        # With several jobs, these are the sum of the time spent by all workers.
+        for phase in ("elf_parsing", "resolution", "patchelf"):
+            timings[phase] = sum(result.timings.get(phase, 0.0) for result in results)
 
-    rpath.extend(append_rpaths)
+        if patchelf_batch:
+            timings["patchelf"] += patchelf_batch.run(extra_args, jobs)
 
-    # Dedup the rpath
-    rpath_str = ":".join(dict.fromkeys(map(Path.as_posix, rpath)))
+        timings["total"] = time.perf_counter() - start
 
-    if rpath:
-        print("setting RPATH to:", rpath_str)
-        subprocess.run(
-                ["patchelf", "--set-rpath", rpath_str, path.as_posix()] + extra_args,
-                check=True)
+        if report_file:
+            write_report(report_file, results, timings, persistent_cache)
 
-    return dependencies
+        dependencies = [dep for result in results for dep in result.dependencies]
+        missing = [dep for dep in dependencies if not dep.found]
+        up_to_date = sum(result.up_to_date for result in results)
 
+        if persistent_cache:
+            print(f"auto-patchelf: reused {persistent_cache.hits} cached library"
+                  f" directory scans, scanned {persistent_cache.misses}")
 
-def auto_patchelf(
-        paths_to_patch: list[Path],
-        lib_dirs: list[Path],
-        runtime_deps: list[Path],
-        recursive: bool = True,
-        ignore_missing: list[str] = [],
-        append_rpaths: list[Path] = [],
-        keep_libc: bool = False,
-        add_existing: bool = True,
-        extra_args: list[str] = []) -> None:
+        print(f"auto-patchelf: {up_to_date} files were already up to date")
 
-    if not paths_to_patch:
-        sys.exit("No paths to patch, stopping.")
+        # Print a summary of the missing dependencies at the end
+        print(f"auto-patchelf: {len(missing)} dependencies could not be satisfied")
+        failure = False
+        for dep in missing:
+            for pattern in ignore_missing:
+                if fnmatch(dep.name.name, pattern):
+                    print(f"warn: auto-patchelf ignoring missing {dep.name} wanted by {dep.file}")
+                    break
+            else:
+                print(f"error: auto-patchelf could not satisfy dependency {dep.name} wanted by {dep.file}")
+                failure = True
 
-    # Add all shared objects of the current output path to the cache,
-    # before lib_dirs, so that they are chosen first in find_dependency.
-    if add_existing:
-        populate_cache(paths_to_patch, recursive)
+        if failure:
+            raise AutoPatchelfError('auto-patchelf failed to find all the required dependencies.\n'
+                                    'Add the missing dependencies to --libs or use '
+                                    '`--ignore-missing="foo.so.1 bar.so etc.so"`.')
 
-    populate_cache(lib_dirs)
+        return results
 
-    dependencies = []
-    for path in chain.from_iterable(glob(p, '*', recursive) for p in paths_to_patch):
-        if not path.is_symlink() and path.is_file():
-            dependencies += auto_patchelf_file(path, runtime_deps, append_rpaths, keep_libc, extra_args)
-
-    missing = [dep for dep in dependencies if not dep.found]
-
-    # Print a summary of the missing dependencies at the end
-    print(f"auto-patchelf: {len(missing)} dependencies could not be satisfied")
-    failure = False
-    for dep in missing:
-        for pattern in ignore_missing:
-            if fnmatch(dep.name.name, pattern):
-                print(f"warn: auto-patchelf ignoring missing {dep.name} wanted by {dep.file}")
-                break
-        else:
-            print(f"error: auto-patchelf could not satisfy dependency {dep.name} wanted by {dep.file}")
-            failure = True
 
-    if failure:
-        sys.exit('auto-patchelf failed to find all the required dependencies.\n'
-                 'Add the missing dependencies to --libs or use '
-                 '`--ignore-missing="foo.so.1 bar.so etc.so"`.')
+# The instance used by forked workers. They inherit it from the parent
+# rather than receiving a pickled copy of its caches with every task.
+worker_patcher: Optional[AutoPatchelf] = None
+
+
+def auto_patchelf_file_logged(path: Path, runtime_deps: list[Path], append_rpaths: list[Path] = [], keep_libc: bool = False, extra_args: list[str] = [], batch: bool = False) -> tuple[str, PatchResult, Optional[PatchelfBatch]]:
+    """
+    Runs auto_patchelf_file in a worker process while capturing its log, so
+    that the parent can print the logs of all files in a deterministic order.
+    When batching, the edits are returned to the parent instead of applied.
+    """
+    assert worker_patcher is not None
+    log = io.StringIO()
+    file_batch = PatchelfBatch() if batch else None
+    with redirect_stdout(log):
+        result = worker_patcher.auto_patchelf_file(path, runtime_deps, append_rpaths, keep_libc, extra_args, file_batch)
+    return log.getvalue(), result, file_batch
+
+
+def write_report(report_file: Path, results: list[PatchResult], timings: dict[str, float], persistent_cache: Optional[PersistentSonameCache]) -> None:
+    """
+    Writes a machine-readable summary of a run, meant for tracking fixup
+    times and RPATH sizes across many builds.
+    """
+    elf_files = [result for result in results if result.is_elf]
+    report = {
+        "version": 1,
+        "timings": timings,
+        "summary": {
+            "files": len(results),
+            "elf_files": len(elf_files),
+            "skipped": sum(result.skipped is not None for result in elf_files),
+            "up_to_date": sum(result.up_to_date for result in elf_files),
+            "missing": sum(not dep.found for result in elf_files for dep in result.dependencies),
+        },
+        "files": [
+            {
+                "path": result.path.as_posix(),
+                "skipped": result.skipped,
+                "up_to_date": result.up_to_date,
+                "interpreter": result.interpreter,
+                "rpath": result.rpath,
+                "dependencies": [
+                    {
+                        "name": name,
+                        "resolution": resolution,
+                        "directory": directory.as_posix() if directory else None,
+                    }
+                    for name, resolution, directory in result.resolutions
+                ],
+                "timings": result.timings,
+            }
+            for result in elf_files
+        ],
+    }
+    if persistent_cache:
+        report["soname_cache"] = {
+            "hits": persistent_cache.hits,
+            "misses": persistent_cache.misses,
+        }
+
+    with report_file.open("w") as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
 
 
 def main() -> None:
+    bintools = Path(os.environ.get('NIX_BINTOOLS', DEFAULT_BINTOOLS))
+    patcher = AutoPatchelf.from_bintools(bintools)
+    if not (patcher.interpreter_arch and patcher.interpreter_osabi):
+        sys.exit("Failed to parse dynamic linker (ld) properties.")
+
     parser = argparse.ArgumentParser(
         prog="auto-patchelf",
         description='auto-patchelf tries as hard as possible to patch the'
@@ -437,6 +1197,40 @@ def main() -> None:
         action="store_false",
         help="Do not add the existing rpaths of the patched files to the list of directories to search for dependencies.",
     )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="Number of files to analyse and patch concurrently."
+             " The output does not depend on this value.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        nargs="?",
+        type=Path,
+        const=default_cache_dir(),
+        default=os.environ.get("AUTO_PATCHELF_CACHE_DIR") or None,
+        help="Directory in which to remember the sonames, architectures and"
+             " RPATHs of the libraries of dependencies, so that their ELF"
+             " headers are parsed once rather than on every build. Uses"
+             " $XDG_CACHE_HOME/auto-patchelf when passed without a value."
+             " $AUTO_PATCHELF_CACHE_DIR enables it by default.",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Patch files only once all of them have been analysed, using a"
+             " single patchelf process for all files needing the same changes.",
+    )
+    parser.add_argument(
+        "--report",
+        dest="report_file",
+        type=Path,
+        default=None,
+        help="Write a JSON report of the patched files, their resolved"
+             " dependencies and RPATH, and the time spent in each phase.",
+    )
     parser.add_argument(
         "--extra-args",
         # Undocumented Python argparse feature: consume all remaining arguments
@@ -452,33 +1246,24 @@ def main() -> None:
     args = parser.parse_args()
     pprint.pprint(vars(args))
 
-    auto_patchelf(
-        args.paths,
-        args.libs,
-        args.runtime_dependencies,
-        args.recursive,
-        args.ignore_missing,
-        append_rpaths=args.append_rpaths,
-        keep_libc=args.keep_libc,
-        add_existing=args.add_existing,
-        extra_args=args.extra_args)
-
+    try:
+        patcher.auto_patchelf(
+            args.paths,
+            args.libs,
+            args.runtime_dependencies,
+            args.recursive,
+            args.ignore_missing,
+            append_rpaths=args.append_rpaths,
+            keep_libc=args.keep_libc,
+            add_existing=args.add_existing,
+            extra_args=args.extra_args,
+            jobs=args.jobs,
+            cache_dir=args.cache_dir,
+            batch=args.batch,
+            report_file=args.report_file)
+    except AutoPatchelfError as e:
+        sys.exit(str(e))
 
-interpreter_path: Path  = None # type: ignore
-interpreter_osabi: str  = None # type: ignore
-interpreter_arch: str   = None # type: ignore
-libc_lib: Path          = None # type: ignore
 
 if __name__ == "__main__":
-    nix_support = Path(os.environ.get('NIX_BINTOOLS', DEFAULT_BINTOOLS)) / 'nix-support'
-    interpreter_path = Path((nix_support / 'dynamic-linker').read_text().strip())
-    libc_lib = Path((nix_support / 'orig-libc').read_text().strip()) / 'lib'
-
-    with open_elf(interpreter_path) as interpreter:
-        interpreter_osabi = get_osabi(interpreter)
-        interpreter_arch = get_arch(interpreter)
-
-    if interpreter_arch and interpreter_osabi and interpreter_path and libc_lib:
-        main()
-    else:
-        sys.exit("Failed to parse dynamic linker (ld) properties.")
+    main()